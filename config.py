@@ -1,19 +1,48 @@
 import os
+import secrets
+import string
+from dataclasses import dataclass
 
-# Bot Configuration
-TOKEN = os.getenv("BOT_TOKEN")
-BOT_USERNAME = os.getenv("BOT_USERNAME", "stampmebot")
-PORT = int(os.getenv("PORT", 10000))
-DATABASE_URL = os.getenv("DATABASE_URL")
+@dataclass(frozen=True, slots=True)
+class Config:
+    token: str
+    bot_username: str
+    port: int
+    webhook_url: str
+    webhook_secret: str
+    database_url: str
+    db_min_size: int
+    db_max_size: int
+    db_max_queries: int
+    db_idle_lifetime: float
+    db_command_timeout: float
+    concurrent_updates: int
+    admin_ids: frozenset
+    brand_footer: str
 
-# Admin Configuration
-ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_IDS", "").split(",") if id.strip()]
-
-# Brand Footer
-BRAND_FOOTER = "\n\n💙 _Powered by StampMe_"
+# Read the environment once at import; the instance is immutable and safe to share
+CONFIG = Config(
+    token=os.getenv("BOT_TOKEN"),
+    bot_username=os.getenv("BOT_USERNAME", "stampmebot"),
+    port=int(os.getenv("PORT", 10000)),
+    # Public base URL of this service; when set, updates arrive by webhook instead of polling
+    webhook_url=os.getenv("WEBHOOK_URL", "").rstrip("/"),
+    # Telegram echoes it in X-Telegram-Bot-Api-Secret-Token; set_webhook re-registers it on every boot,
+    # so a fresh random one per process works unless several instances share the webhook
+    webhook_secret=os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32),
+    database_url=os.getenv("DATABASE_URL"),
+    db_min_size=int(os.getenv("DB_MIN_SIZE", 5)),
+    db_max_size=int(os.getenv("DB_MAX_SIZE", 20)),
+    db_max_queries=int(os.getenv("DB_MAX_QUERIES", 50000)),
+    db_idle_lifetime=float(os.getenv("DB_IDLE_LIFETIME", 300)),
+    db_command_timeout=float(os.getenv("DB_COMMAND_TIMEOUT", 15)),
+    concurrent_updates=int(os.getenv("CONCURRENT_UPDATES", 256)),
+    admin_ids=frozenset(int(id.strip()) for id in os.getenv("ADMIN_IDS", "").split(",") if id.strip()),
+    brand_footer="\n\n💙 _Powered by StampMe_",
+)
 
 # Message Templates
-MESSAGES = {
+_RAW_MESSAGES = {
     'welcome_customer': (
         "👋 Hi {name}!\n\n"
         "Welcome to StampMe! We help you collect stamps "
@@ -62,6 +91,11 @@ MESSAGES = {
         "{progress_bar}\n\n"
         "{message}"
     ),
+    'stamp_rejected': (
+        "❌ *Stamp request declined*\n\n"
+        "📋 {campaign}\n\n"
+        "If you think this is a mistake, please ask the store."
+    ),
     'reward_earned': (
         "🎉 *REWARD EARNED!*\n\n"
         "Congratulations! You've completed:\n"
@@ -77,10 +111,41 @@ MESSAGES = {
         "⏳ Pending requests: {pending}\n\n"
         "💡 *Tip:* {tip}"
     ),
+    'merchant_application': (
+        "🏪 *New Merchant Application*\n\n"
+        "👤 {name} (ID: {user_id})\n\n"
+        "Open /admin to review pending merchants."
+    ),
 }
 
+
+_MARKDOWN_ESCAPES = str.maketrans({char: '\\' + char for char in '_*`['})
+
+
+def _escape_md(value):
+    """Escape Telegram Markdown control characters in a substituted value."""
+    return value.translate(_MARKDOWN_ESCAPES)
+
+
+def _compile(template):
+    """Parse a format template (footer included) once and return a keyword renderer for it."""
+    parts = list(string.Formatter().parse(template + CONFIG.brand_footer))
+
+    def render(**fields):
+        return ''.join(
+            literal + (_escape_md(format(fields[name], spec)) if name is not None else '')
+            for literal, name, spec, _ in parts
+        )
+
+    return render
+
+
+# Compiled at import: MESSAGES['stamp_approved'](campaign=..., current=..., ...)
+# returns the finished Markdown text, brand footer included and fields escaped.
+MESSAGES = {key: _compile(template) for key, template in _RAW_MESSAGES.items()}
+
 # Tips for merchants
-MERCHANT_TIPS = [
+MERCHANT_TIPS = (
     "Post your QR code near the counter to boost engagement!",
     "Respond to stamp requests quickly to keep customers happy.",
     "Add multiple reward tiers to encourage repeat visits.",
@@ -88,7 +153,7 @@ MERCHANT_TIPS = [
     "Update your campaign description to make it more appealing.",
     "Check your analytics weekly to understand customer behavior.",
     "Consider running a limited-time bonus stamp promotion!",
-]
+)
 
 
 # ============================================
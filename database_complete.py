@@ -1,408 +1,862 @@
+import asyncio
 import asyncpg
-from datetime import datetime, timedelta
+import json
+import logging
+import time
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from datetime import date, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Hot-path queries prepared once per pool connection (see _prepare_statements)
+HOT_QUERIES = {
+    'get_campaign': 'SELECT * FROM campaigns WHERE id = $1',
+    'get_enrollment': '''
+        SELECT * FROM enrollments 
+        WHERE campaign_id = $1 AND customer_id = $2
+    ''',
+    'add_stamp_and_check': '''
+        WITH tx AS (
+            INSERT INTO transactions (enrollment_id, merchant_id, action_type, stamps_change)
+            VALUES ($1, $2, 'stamp_added', 1)
+        ), upd AS (
+            UPDATE enrollments e
+            SET stamps = e.stamps + 1, last_stamp_at = NOW(),
+                completed = e.completed OR e.stamps + 1 >= c.stamps_needed,
+                completed_at = CASE WHEN NOT e.completed AND e.stamps + 1 >= c.stamps_needed
+                                    THEN NOW() ELSE e.completed_at END
+            FROM campaigns c
+            WHERE e.id = $1 AND c.id = e.campaign_id
+            RETURNING e.stamps, e.completed, e.stamps = c.stamps_needed AS just_completed
+        )
+        SELECT stamps, completed, just_completed FROM upd
+    ''',
+    'enroll_customer': '''
+        WITH enroll AS (
+            INSERT INTO enrollments (campaign_id, customer_id)
+            VALUES ($1, $2)
+            ON CONFLICT (campaign_id, customer_id) DO UPDATE SET campaign_id = EXCLUDED.campaign_id
+            RETURNING id, stamps, joined_at, xmax = 0 AS joined
+        ), bump AS (
+            UPDATE campaigns SET total_joins = total_joins + 1
+            WHERE id = $1 AND EXISTS (SELECT 1 FROM enroll WHERE joined)
+        )
+        SELECT id, stamps, joined_at, joined FROM enroll
+    ''',
+    'upsert_user': '''
+        INSERT INTO users (id, username, first_name, user_type, last_active)
+        VALUES ($1, $2, $3, $4, NOW())
+        ON CONFLICT (id) DO UPDATE SET
+            username = EXCLUDED.username,
+            first_name = EXCLUDED.first_name,
+            last_active = NOW()
+        RETURNING *
+    ''',
+    'get_user': 'SELECT * FROM users WHERE id = $1',
+    'create_stamp_request': '''
+        INSERT INTO stamp_requests 
+        (campaign_id, customer_id, merchant_id, enrollment_id, customer_message)
+        VALUES ($1, $2, $3, $4, $5)
+        RETURNING id
+    ''',
+    'reject_stamp_request': '''
+        UPDATE stamp_requests sr
+        SET status = 'rejected', rejection_reason = $3, processed_at = NOW()
+        FROM campaigns c
+        WHERE sr.id = $1 AND sr.merchant_id = $2 AND sr.status = 'pending' AND c.id = sr.campaign_id
+        RETURNING sr.*, c.name AS campaign_name
+    ''',
+    'get_pending_count': '''
+        SELECT COUNT(*) FROM stamp_requests 
+        WHERE merchant_id = $1 AND status = 'pending'
+    ''',
+}
+
+# Fields update_merchant_settings accepts, in the order its SET list names them
+MERCHANT_SETTINGS_COLUMNS = (
+    'require_approval',
+    'auto_approve',
+    'daily_summary_enabled',
+    'notification_hour',
+    'business_name',
+    'business_type',
+    'location',
+)
+
+# user_preferences flags toggle_user_preference can flip, with the value a NULL stands for
+USER_PREFERENCE_DEFAULTS = {
+    'notification_enabled': True,
+    'marketing_emails': True,
+    'data_sharing': False,
+}
+
+class TTLCache:
+    """Small in-process cache: entries expire after ttl seconds, oldest evicted past maxsize"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+    
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self._data[key]
+            return None
+        return entry[1]
+    
+    def set(self, key, value):
+        self._data.pop(key, None)
+        if len(self._data) >= self.maxsize:
+            # dicts keep insertion order, so the first key is the oldest entry
+            del self._data[next(iter(self._data))]
+        self._data[key] = (time.monotonic(), value)
+    
+    def pop(self, key):
+        self._data.pop(key, None)
+    
+    def clear(self):
+        self._data.clear()
+
+class StampMeConnection(asyncpg.Connection):
+    __slots__ = ('statements',)
 
 class StampMeDatabase:
-    def __init__(self, database_url: str):
+    def __init__(self, database_url: str, min_size: int = 5, max_size: int = 20,
+                 max_queries: int = 50000, idle_lifetime: float = 300, command_timeout: float = 15):
         self.pool = None
         self.db_url = database_url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_queries = max_queries
+        self.idle_lifetime = idle_lifetime
+        self.command_timeout = command_timeout
+        # Read-mostly rows served from memory; the write methods below keep them fresh
+        self._user_cache = TTLCache(maxsize=10_000, ttl=60)
+        self._campaign_cache = TTLCache(maxsize=5_000, ttl=300)
+        self._settings_cache = TTLCache(maxsize=5_000, ttl=300)
+        self._prefs_cache = TTLCache(maxsize=10_000, ttl=60)
+        # The store directory is the same for every customer, so one short-lived copy serves all of them
+        self._stores_cache = TTLCache(maxsize=16, ttl=30)
+        # Pending request counts, dropped by the pending_changed NOTIFY the stamp_requests trigger sends
+        self._pending_counts = TTLCache(maxsize=10_000, ttl=300)
+        # merchant_id -> pending_changed NOTIFYs seen; a count read across a change isn't cached
+        self._pending_generation = Counter()
+        self._listener = None
+        self._listener_task = None
+        self._closing = False
+        # Set by the notifications_new NOTIFY; send_notifications waits on it
+        self._notifications_ready = asyncio.Event()
+        # merchant_id -> [visits, stamps_given] not yet written to daily_stats. The day is the database's
+        # CURRENT_DATE at flush time, like every other date here; a flush just past midnight books up to
+        # one interval of the old day's counts on the new one
+        self._stats_buffer = defaultdict(lambda: [0, 0])
+        self._flush_task = None
     
     async def connect(self):
         self.pool = await asyncpg.create_pool(
             self.db_url,
-            min_size=2,
-            max_size=10,
-            command_timeout=60
+            min_size=self.min_size,
+            max_size=self.max_size,
+            max_queries=self.max_queries,
+            max_inactive_connection_lifetime=self.idle_lifetime,
+            statement_cache_size=1024,
+            command_timeout=self.command_timeout,
+            connection_class=StampMeConnection,
+            init=self._prepare_statements,
+            reset=self._skip_reset,
+            server_settings={'jit': 'off'}
         )
         # Don't create tables here - they're already migrated
-        print("✅ Database connected")
+        self._flush_task = asyncio.create_task(self._flush_stats_loop())
+        if not await self._start_listener():
+            self._reconnect_listener()
+        logger.info("✅ Database connected")
+    
+    async def _start_listener(self) -> bool:
+        """LISTEN for the migration triggers' NOTIFYs on a dedicated connection, outside the pool"""
+        try:
+            self._listener = await asyncpg.connect(self.db_url)
+            await self._listener.add_listener('pending_changed', self._on_pending_changed)
+            await self._listener.add_listener('notifications_new', self._on_notifications_new)
+            self._listener.add_termination_listener(self._on_listener_lost)
+            return True
+        except Exception as e:
+            # Without the listener get_pending_count stops caching and notifications are polled
+            logger.warning(f"Pending-count listener unavailable: {e}")
+            if self._listener:
+                self._listener.terminate()
+            self._listener = None
+            return False
+    
+    def _reconnect_listener(self):
+        if not self._closing and (self._listener_task is None or self._listener_task.done()):
+            self._listener_task = asyncio.create_task(self._listener_backoff())
+    
+    async def _listener_backoff(self, delay: float = 1, max_delay: float = 60):
+        """Retry the listener connection, doubling the wait after each failure"""
+        while not self._closing:
+            await asyncio.sleep(delay)
+            if await self._start_listener():
+                logger.info("✅ Pending-count listener reconnected")
+                # Anything queued while it was down would otherwise wait for the sweep
+                self._notifications_ready.set()
+                return
+            delay = min(delay * 2, max_delay)
+    
+    def _on_pending_changed(self, conn, pid, channel, payload):
+        if payload:
+            merchant_id = int(payload)
+            self._pending_generation[merchant_id] += 1
+            self._pending_counts.pop(merchant_id)
+    
+    def _on_notifications_new(self, conn, pid, channel, payload):
+        self._notifications_ready.set()
     
-    async def close(self):
+    def _on_listener_lost(self, conn):
+        # Notifications may have been missed, so nothing cached can be trusted any more
+        self._listener = None
+        self._pending_counts.clear()
+        self._reconnect_listener()
+    
+    async def _prepare_statements(self, conn):
+        """Register codecs and plan the hot queries once, when the pool opens the connection"""
+        await conn.set_type_codec('json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+        conn.statements = {name: await conn.prepare(query) for name, query in HOT_QUERIES.items()}
+    
+    @staticmethod
+    async def _skip_reset(conn):
+        """Release connections without the default DISCARD-style reset round trip.
+
+        Nothing here leaves session state behind (no SET, temp tables or LISTEN on
+        pooled connections), so there is nothing to reset.
+        """
+    
+    async def close(self, timeout: float = 10):
+        """Wait for in-flight queries to finish, terminating whatever is left after timeout"""
+        # Set first: closing the listener fires _on_listener_lost, which must not reconnect it
+        self._closing = True
+        if self._listener_task:
+            self._listener_task.cancel()
+        if self._flush_task:
+            self._flush_task.cancel()
+            # A flush cut short folds its counts back into the buffer; wait for that before the final flush
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        if self._listener:
+            await self._listener.close()
         if self.pool:
-            await self.pool.close()
+            # A failed final flush is logged, but must not keep the pool from closing
+            try:
+                await self.flush_stats()
+            except Exception as e:
+                logger.warning(f"Final stats flush failed: {e}")
+            try:
+                await asyncio.wait_for(self.pool.close(), timeout)
+            except asyncio.TimeoutError:
+                self.terminate()
     
-    async def create_or_update_user(self, user_id: int, username: str, first_name: str, user_type: str = 'customer'):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO users (id, username, first_name, user_type, last_active)
-                VALUES ($1, $2, $3, $4, NOW())
-                ON CONFLICT (id) DO UPDATE SET
-                    username = EXCLUDED.username,
-                    first_name = EXCLUDED.first_name,
-                    last_active = NOW()
-            ''', user_id, username, first_name, user_type)
-    
-    async def get_user(self, user_id: int):
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('SELECT * FROM users WHERE id = $1', user_id)
-            return dict(row) if row else None
+    def _count_stamp(self, merchant_id: int, stamps: int = 1):
+        counts = self._stats_buffer[merchant_id]
+        counts[0] += stamps
+        counts[1] += stamps
+    
+    async def flush_stats(self):
+        """Write the buffered daily_stats increments in a single upsert"""
+        if not self._stats_buffer:
+            return
+        buffer, self._stats_buffer = self._stats_buffer, defaultdict(lambda: [0, 0])
+        merchant_ids = list(buffer)
+        try:
+            await self.pool.execute('''
+                INSERT INTO daily_stats (merchant_id, date, visits, stamps_given)
+                SELECT merchant_id, CURRENT_DATE, visits, stamps_given
+                FROM unnest($1::bigint[], $2::int[], $3::int[]) AS t(merchant_id, visits, stamps_given)
+                ON CONFLICT (merchant_id, date)
+                DO UPDATE SET visits = daily_stats.visits + EXCLUDED.visits, 
+                            stamps_given = daily_stats.stamps_given + EXCLUDED.stamps_given
+            ''', merchant_ids, [buffer[key][0] for key in merchant_ids], [buffer[key][1] for key in merchant_ids])
+        except BaseException:
+            # Fold the counts back in so the next flush retries them; BaseException, so a
+            # cancellation mid-INSERT (close() stopping the loop) doesn't lose them either
+            for key, (visits, stamps_given) in buffer.items():
+                counts = self._stats_buffer[key]
+                counts[0] += visits
+                counts[1] += stamps_given
+            raise
     
-    async def request_merchant_access(self, user_id: int):
+    async def _flush_stats_loop(self, interval: float = 5):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_stats()
+            except Exception as e:
+                logger.warning(f"Stats flush failed: {e}")
+    
+    def session(self):
+        """Hold one pool connection across several calls: pass it as conn= to each method"""
+        return self.pool.acquire()
+    
+    def _acquire(self, conn=None):
+        # Reuse the caller's session connection, otherwise borrow one for this call
+        return nullcontext(conn) if conn is not None else self.pool.acquire()
+    
+    def terminate(self):
+        """Drop every pool connection immediately, for signal handlers"""
+        self._closing = True
+        if self._listener:
+            self._listener.terminate()
+        if self.pool:
+            self.pool.terminate()
+    
+    async def ensure_transaction_partitions(self, months_ahead: int = 1):
+        """Create monthly transactions partitions for this month and the next months_ahead"""
         async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE users SET user_type = 'merchant' WHERE id = $1", user_id)
+            # Databases migrated before partitioning keep a plain transactions table
+            partitioned = await conn.fetchval(
+                "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'transactions'::regclass)"
+            )
+            if not partitioned:
+                return
+            month = date.today().replace(day=1)
+            for _ in range(months_ahead + 1):
+                next_month = (month + timedelta(days=32)).replace(day=1)
+                await conn.execute(f'''
+                    CREATE TABLE IF NOT EXISTS transactions_{month:%Y%m}
+                    PARTITION OF transactions FOR VALUES FROM ('{month}') TO ('{next_month}')
+                ''')
+                month = next_month
+    
+    async def create_or_update_user(self, user_id: int, username: str, first_name: str, user_type: str = 'customer', conn=None):
+        async with self._acquire(conn) as conn:
+            row = await conn.statements['upsert_user'].fetchrow(user_id, username, first_name, user_type)
+        self._user_cache.set(user_id, row)
+    
+    async def get_user(self, user_id: int, conn=None):
+        row = self._user_cache.get(user_id)
+        if row is not None:
+            return row
+        async with self._acquire(conn) as conn:
+            row = await conn.statements['get_user'].fetchrow(user_id)
+        if row:
+            self._user_cache.set(user_id, row)
+        return row
+    
+    def invalidate_user(self, user_id: int):
+        """Drop a user from the get_user cache after changing their row"""
+        self._user_cache.pop(user_id)
+    
+    async def request_merchant_access(self, user_id: int, notify_ids=(), message: str = None):
+        """Mark the user as an applying merchant and queue message to each of notify_ids"""
+        # The notifications ride along in the same statement, however many admins there are
+        row = await self.pool.fetchrow('''
+            WITH u AS (
+                UPDATE users SET user_type = 'merchant'
+                WHERE id = $1
+                RETURNING *
+            ), n AS (
+                INSERT INTO notifications (user_id, message)
+                SELECT admin_id, $3::text FROM unnest($2::bigint[]) AS admin_id
+                WHERE $3::text IS NOT NULL AND EXISTS (SELECT 1 FROM u)
+            )
+            SELECT * FROM u
+        ''', user_id, list(notify_ids), message)
+        if row:
+            self._user_cache.set(user_id, row)
+        else:
+            self.invalidate_user(user_id)
+        return row
     
     async def approve_merchant(self, user_id: int, admin_id: int):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
+        # Approval and the default settings row in one statement; the settings row is only
+        # created if the user actually exists
+        row = await self.pool.fetchrow('''
+            WITH u AS (
                 UPDATE users SET 
                     merchant_approved = TRUE,
                     merchant_approved_at = NOW(),
                     merchant_approved_by = $2
                 WHERE id = $1
-            ''', user_id, admin_id)
-            
-            await conn.execute('''
+                RETURNING *
+            ), s AS (
                 INSERT INTO merchant_settings (merchant_id)
-                VALUES ($1)
+                SELECT id FROM u
                 ON CONFLICT (merchant_id) DO NOTHING
-            ''', user_id)
+            )
+            SELECT * FROM u
+        ''', user_id, admin_id)
+        # RETURNING * is the same shape get_user caches, so write the fresh row through
+        if row:
+            self._user_cache.set(user_id, row)
+        else:
+            self.invalidate_user(user_id)
+        return row
     
     async def get_pending_merchants(self):
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT * FROM users 
-                WHERE user_type = 'merchant' AND merchant_approved = FALSE
-                ORDER BY created_at
-            ''')
-            return [dict(row) for row in rows]
-    
-    async def is_merchant_approved(self, user_id: int) -> bool:
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchval('''
-                SELECT merchant_approved FROM users 
-                WHERE id = $1 AND user_type = 'merchant'
-            ''', user_id)
-            return result or False
+        return await self.pool.fetch('''
+            SELECT * FROM users 
+            WHERE user_type = 'merchant' AND merchant_approved = FALSE
+            ORDER BY created_at
+        ''')
+    
+    async def is_merchant_approved(self, user_id: int, conn=None) -> bool:
+        # Answered from the cached user row rather than a query of its own
+        user = await self.get_user(user_id, conn=conn)
+        return bool(user and user['user_type'] == 'merchant' and user['merchant_approved'])
     
     async def create_campaign(self, merchant_id: int, name: str, stamps_needed: int, 
                             description: str = None, reward_description: str = None,
-                            expires_days: int = None):
-        async with self.pool.acquire() as conn:
-            expires_at = None
-            if expires_days:
-                expires_at = datetime.now() + timedelta(days=expires_days)
-            
-            campaign_id = await conn.fetchval('''
-                INSERT INTO campaigns (merchant_id, name, description, stamps_needed, reward_description, expires_at)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                RETURNING id
-            ''', merchant_id, name, description, stamps_needed, reward_description, expires_at)
-            
-            return campaign_id
+                            expires_days: int = None, category: str = None):
+        row = await self.pool.fetchrow('''
+            INSERT INTO campaigns (merchant_id, name, description, stamps_needed, reward_description, category, expires_at)
+            VALUES ($1, $2, $3, $4, $5, $6, NOW() + make_interval(days => NULLIF($7::int, 0)))
+            RETURNING *
+        ''', merchant_id, name, description, stamps_needed, reward_description, category, expires_days)
+        # Write through: the share link goes out straight away and its first join shouldn't miss
+        self._campaign_cache.set(row['id'], row)
+        return row['id']
     
-    async def get_campaign(self, campaign_id: int):
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('SELECT * FROM campaigns WHERE id = $1', campaign_id)
-            return dict(row) if row else None
+    async def get_campaign(self, campaign_id: int, conn=None):
+        # Nothing edits or deactivates a campaign after create_campaign; the only later writes bump
+        # total_joins/total_completions, which no reader of the cached row uses. A method that changes
+        # any other column must pop the campaign from _campaign_cache
+        row = self._campaign_cache.get(campaign_id)
+        if row is not None:
+            return row
+        async with self._acquire(conn) as conn:
+            row = await conn.statements['get_campaign'].fetchrow(campaign_id)
+        if row:
+            self._campaign_cache.set(campaign_id, row)
+        return row
     
     async def get_merchant_campaigns(self, merchant_id: int):
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT * FROM campaigns 
-                WHERE merchant_id = $1 AND active = TRUE 
-                ORDER BY created_at DESC
-            ''', merchant_id)
-            return [dict(row) for row in rows]
+        return await self.pool.fetch('''
+            SELECT * FROM campaigns 
+            WHERE merchant_id = $1 AND active = TRUE 
+            ORDER BY created_at DESC
+        ''', merchant_id)
+    
+    async def get_merchant_totals(self, merchant_id: int):
+        """Program and customer totals across all of a merchant's campaigns, in one query"""
+        return await self.pool.fetchrow('''
+            SELECT COUNT(*) AS programs,
+                   COUNT(*) FILTER (WHERE c.active) AS active_programs,
+                   COALESCE(SUM(e.customers), 0)::int AS customers,
+                   COALESCE(SUM(e.completed), 0)::int AS completed,
+                   COALESCE(SUM(e.stamps), 0)::int AS stamps
+            FROM campaigns c
+            LEFT JOIN LATERAL (
+                SELECT COUNT(*) AS customers,
+                       COUNT(*) FILTER (WHERE completed) AS completed,
+                       SUM(stamps) AS stamps
+                FROM enrollments
+                WHERE campaign_id = c.id
+            ) e ON TRUE
+            WHERE c.merchant_id = $1
+        ''', merchant_id)
+    
+    async def get_merchant_campaign_summaries(self, merchant_id: int):
+        """Active campaigns with their customer and completion counts, aggregated in one query"""
+        return await self.pool.fetch('''
+            SELECT c.id, c.name, c.stamps_needed, c.reward_description, c.active,
+                   COUNT(e.id) AS customer_count,
+                   COUNT(*) FILTER (WHERE e.completed) AS completed_count
+            FROM campaigns c
+            LEFT JOIN enrollments e ON e.campaign_id = c.id
+            WHERE c.merchant_id = $1 AND c.active = TRUE
+            GROUP BY c.id
+            ORDER BY c.created_at DESC
+        ''', merchant_id)
+    
+    async def get_participating_stores(self, limit: int = 15):
+        """Approved merchants with active programs, grouped by category"""
+        stores = self._stores_cache.get(limit)
+        if stores is not None:
+            return stores
+        # category is added by the bot's own migrations after the pool opens, so this can't be
+        # prepared in _prepare_statements; the fixed text still hits asyncpg's statement cache
+        stores = await self.pool.fetch('''
+            SELECT u.id, u.first_name, u.username, c.category, COUNT(c.id) AS program_count
+            FROM users u
+            JOIN campaigns c ON c.merchant_id = u.id
+            WHERE u.user_type = 'merchant' AND u.merchant_approved = TRUE AND c.active = TRUE
+            GROUP BY u.id, u.first_name, u.username, c.category
+            ORDER BY program_count DESC
+            LIMIT $1
+        ''', limit)
+        self._stores_cache.set(limit, stores)
+        return stores
     
     async def add_reward_tier(self, campaign_id: int, stamps_required: int, reward_name: str, description: str = None):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO reward_tiers (campaign_id, stamps_required, reward_name, reward_description)
-                VALUES ($1, $2, $3, $4)
-            ''', campaign_id, stamps_required, reward_name, description)
+        await self.pool.execute('''
+            INSERT INTO reward_tiers (campaign_id, stamps_required, reward_name, reward_description)
+            VALUES ($1, $2, $3, $4)
+        ''', campaign_id, stamps_required, reward_name, description)
     
     async def get_campaign_rewards(self, campaign_id: int):
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT * FROM reward_tiers 
-                WHERE campaign_id = $1 
-                ORDER BY stamps_required
-            ''', campaign_id)
-            return [dict(row) for row in rows]
-    
-    async def enroll_customer(self, campaign_id: int, customer_id: int):
-        async with self.pool.acquire() as conn:
-            enrollment_id = await conn.fetchval('''
-                INSERT INTO enrollments (campaign_id, customer_id)
-                VALUES ($1, $2)
-                ON CONFLICT (campaign_id, customer_id) 
-                DO UPDATE SET joined_at = enrollments.joined_at
-                RETURNING id
-            ''', campaign_id, customer_id)
-            
-            await conn.execute('UPDATE campaigns SET total_joins = total_joins + 1 WHERE id = $1', campaign_id)
-            
-            return enrollment_id
+        return await self.pool.fetch('''
+            SELECT * FROM reward_tiers 
+            WHERE campaign_id = $1 
+            ORDER BY stamps_required
+        ''', campaign_id)
     
-    async def get_enrollment(self, campaign_id: int, customer_id: int):
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow('''
-                SELECT * FROM enrollments 
-                WHERE campaign_id = $1 AND customer_id = $2
-            ''', campaign_id, customer_id)
-            return dict(row) if row else None
-    
-    async def get_customer_enrollments(self, customer_id: int):
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT e.id, e.campaign_id, e.customer_id, e.stamps, e.joined_at, 
-                       e.last_stamp_at, e.completed, e.completed_at, e.rating, e.feedback,
-                       ca.name, ca.stamps_needed, ca.expires_at,
-                       u.first_name as merchant_name
-                FROM enrollments e
-                JOIN campaigns ca ON e.campaign_id = ca.id
-                JOIN users u ON ca.merchant_id = u.id
-                WHERE e.customer_id = $1 AND ca.active = TRUE
-                ORDER BY e.last_stamp_at DESC NULLS LAST, e.joined_at DESC
-            ''', customer_id)
-            return [dict(row) for row in rows]
+    async def enroll_customer(self, campaign_id: int, customer_id: int, conn=None):
+        """Enroll (or find) the customer; joined is TRUE only when this call created the row"""
+        # The no-op DO UPDATE locks and returns the existing row even when a concurrent first join
+        # committed after this statement's snapshot, where DO NOTHING plus a re-read would find nothing
+        async with self._acquire(conn) as conn:
+            return await conn.statements['enroll_customer'].fetchrow(campaign_id, customer_id)
+
+    async def get_enrollment(self, campaign_id: int, customer_id: int, conn=None):
+        async with self._acquire(conn) as conn:
+            return await conn.statements['get_enrollment'].fetchrow(campaign_id, customer_id)
     
     async def get_campaign_customers(self, campaign_id: int):
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT e.*, u.username, u.first_name
-                FROM enrollments e
-                JOIN users u ON e.customer_id = u.id
-                WHERE e.campaign_id = $1
-                ORDER BY e.stamps DESC, e.joined_at
-            ''', campaign_id)
-            return [dict(row) for row in rows]
+        return await self.pool.fetch('''
+            SELECT e.*, u.username, u.first_name
+            FROM enrollments e
+            JOIN users u ON e.customer_id = u.id
+            WHERE e.campaign_id = $1
+            ORDER BY e.stamps DESC, e.joined_at
+        ''', campaign_id)
     
-    async def create_stamp_request(self, campaign_id: int, customer_id: int, 
-                                  merchant_id: int, enrollment_id: int, message: str = None):
-        async with self.pool.acquire() as conn:
-            request_id = await conn.fetchval('''
-                INSERT INTO stamp_requests 
-                (campaign_id, customer_id, merchant_id, enrollment_id, customer_message)
-                VALUES ($1, $2, $3, $4, $5)
-                RETURNING id
-            ''', campaign_id, customer_id, merchant_id, enrollment_id, message)
-            
-            return request_id
+    async def get_campaign_stats(self, campaign_id: int, days: int = 30):
+        return await self.pool.fetchrow('''
+            WITH e AS (
+                SELECT COUNT(*) AS total_customers,
+                       COUNT(*) FILTER (WHERE completed) AS completed_customers,
+                       COALESCE(SUM(stamps), 0) AS total_stamps,
+                       COALESCE(AVG(stamps), 0)::float AS avg_stamps
+                FROM enrollments
+                WHERE campaign_id = $1
+            ), t AS (
+                SELECT COUNT(*) AS recent_stamps
+                FROM transactions
+                WHERE enrollment_id IN (SELECT id FROM enrollments WHERE campaign_id = $1)
+                AND created_at >= NOW() - make_interval(days => $2::int)
+            )
+            SELECT * FROM e, t
+        ''', campaign_id, days)
     
-    async def get_pending_requests(self, merchant_id: int):
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT sr.id, sr.campaign_id, sr.customer_id, sr.merchant_id, 
-                       sr.enrollment_id, sr.status, sr.customer_message, sr.created_at,
-                       ca.name as campaign_name, ca.stamps_needed,
-                       u.username, u.first_name,
-                       e.stamps as current_stamps
-                FROM stamp_requests sr
-                JOIN campaigns ca ON sr.campaign_id = ca.id
-                JOIN users u ON sr.customer_id = u.id
-                JOIN enrollments e ON sr.enrollment_id = e.id
-                WHERE sr.merchant_id = $1 AND sr.status = 'pending'
-                ORDER BY sr.created_at ASC
-            ''', merchant_id)
-            return [dict(row) for row in rows]
+    async def add_stamp_and_check(self, enrollment_id: int, merchant_id: int, conn=None):
+        """Add a stamp and mark the card completed once it reaches stamps_needed"""
+        async with self._acquire(conn) as conn:
+            return await conn.statements['add_stamp_and_check'].fetchrow(enrollment_id, merchant_id)
     
-    async def approve_stamp_request(self, request_id: int):
-        async with self.pool.acquire() as conn:
-            request = await conn.fetchrow(
-                'SELECT * FROM stamp_requests WHERE id = $1 AND status = $2',
-                request_id, 'pending'
+    async def create_stamp_request(self, campaign_id: int, customer_id: int, 
+                                  merchant_id: int, enrollment_id: int, message: str = None, conn=None):
+        async with self._acquire(conn) as conn:
+            return await conn.statements['create_stamp_request'].fetchval(
+                campaign_id, customer_id, merchant_id, enrollment_id, message
             )
-            
-            if not request:
-                return None
-            
-            new_stamps = await conn.fetchval('''
-                UPDATE enrollments 
-                SET stamps = stamps + 1, last_stamp_at = NOW()
-                WHERE id = $1
-                RETURNING stamps
-            ''', request['enrollment_id'])
-            
-            campaign = await conn.fetchrow('SELECT * FROM campaigns WHERE id = $1', request['campaign_id'])
-            
-            completed = new_stamps >= campaign['stamps_needed']
-            
-            if completed:
-                await conn.execute('''
-                    UPDATE enrollments 
-                    SET completed = TRUE, completed_at = NOW()
-                    WHERE id = $1
-                ''', request['enrollment_id'])
-                
-                await conn.execute('UPDATE campaigns SET total_completions = total_completions + 1 WHERE id = $1', request['campaign_id'])
-                await conn.execute('UPDATE users SET total_rewards_claimed = total_rewards_claimed + 1 WHERE id = $1', request['customer_id'])
-            
-            await conn.execute('''
-                UPDATE stamp_requests 
+    
+    async def get_pending_requests(self, merchant_id: int, limit: int = None):
+        """Oldest pending requests first, up to limit, plus the total number pending"""
+        rows = await self.pool.fetch('''
+            SELECT sr.id, sr.campaign_id, sr.customer_id, sr.merchant_id, 
+                   sr.enrollment_id, sr.status, sr.customer_message,
+                   to_char(sr.created_at, 'YYYY-MM-DD HH24:MI') AS created_at,
+                   ca.name as campaign_name, ca.stamps_needed,
+                   u.username, u.first_name,
+                   e.stamps as current_stamps,
+                   COUNT(*) OVER () AS total_pending
+            FROM stamp_requests sr
+            JOIN campaigns ca ON sr.campaign_id = ca.id
+            JOIN users u ON sr.customer_id = u.id
+            JOIN enrollments e ON sr.enrollment_id = e.id
+            WHERE sr.merchant_id = $1 AND sr.status = 'pending'
+            ORDER BY sr.created_at ASC
+            LIMIT $2
+        ''', merchant_id, limit)
+        # The window count is taken before LIMIT, so any row carries the full total
+        return rows, rows[0]['total_pending'] if rows else 0
+    
+    async def approve_stamp_requests_bulk(self, merchant_id: int, request_ids=None):
+        """Approve one, several or all (request_ids None) of a merchant's pending requests in one statement.
+
+        Single-request approvals go through here too. Returns one row per stamped enrollment:
+        customer_id, campaign_id, name, stamps_needed, new_stamps, stamps_added and just_completed.
+        """
+        # Every write hangs off the claimed requests, so the whole approval is one atomic round trip;
+        # grouping means a customer with several pending requests on one card gets one enrollment update.
+        # campaigns is joined into that UPDATE, so stamps_needed and name come back without a re-read
+        rows = await self.pool.fetch('''
+            WITH req AS (
+                UPDATE stamp_requests
                 SET status = 'approved', processed_at = NOW()
-                WHERE id = $1
-            ''', request_id)
-            
-            await conn.execute('''
+                WHERE merchant_id = $1 AND status = 'pending'
+                AND ($2::int[] IS NULL OR id = ANY($2::int[]))
+                RETURNING enrollment_id, customer_id, merchant_id
+            ), per_enr AS (
+                SELECT enrollment_id, COUNT(*)::int AS n FROM req GROUP BY enrollment_id
+            ), enr AS (
+                UPDATE enrollments e
+                SET stamps = e.stamps + p.n, last_stamp_at = NOW(),
+                    completed = e.completed OR e.stamps + p.n >= c.stamps_needed,
+                    completed_at = CASE WHEN NOT e.completed AND e.stamps + p.n >= c.stamps_needed
+                                        THEN NOW() ELSE e.completed_at END
+                FROM per_enr p, campaigns c
+                WHERE e.id = p.enrollment_id AND c.id = e.campaign_id
+                RETURNING e.customer_id, e.campaign_id, c.name, c.stamps_needed,
+                          e.stamps AS new_stamps, p.n AS stamps_added,
+                          e.stamps >= c.stamps_needed AND e.stamps - p.n < c.stamps_needed AS just_completed
+            ), camp AS (
+                UPDATE campaigns c SET total_completions = c.total_completions + x.n
+                FROM (SELECT campaign_id, COUNT(*) AS n FROM enr WHERE just_completed GROUP BY campaign_id) x
+                WHERE c.id = x.campaign_id
+            ), usr AS (
+                UPDATE users u
+                SET total_stamps_earned = u.total_stamps_earned + x.stamps,
+                    total_rewards_claimed = u.total_rewards_claimed + x.rewards
+                FROM (
+                    SELECT customer_id, SUM(stamps_added)::int AS stamps,
+                           COUNT(*) FILTER (WHERE just_completed)::int AS rewards
+                    FROM enr GROUP BY customer_id
+                ) x
+                WHERE u.id = x.customer_id
+            ), tx AS (
                 INSERT INTO transactions (enrollment_id, merchant_id, action_type, stamps_change)
-                VALUES ($1, $2, 'stamp_added', 1)
-            ''', request['enrollment_id'], request['merchant_id'])
-            
-            await conn.execute('UPDATE users SET total_stamps_earned = total_stamps_earned + 1 WHERE id = $1', request['customer_id'])
-            
-            await conn.execute('''
-                INSERT INTO daily_stats (merchant_id, date, visits, stamps_given)
-                VALUES ($1, CURRENT_DATE, 1, 1)
-                ON CONFLICT (merchant_id, date)
-                DO UPDATE SET visits = daily_stats.visits + 1, 
-                            stamps_given = daily_stats.stamps_given + 1
-            ''', request['merchant_id'])
-            
-            return {
-                'new_stamps': new_stamps,
-                'completed': completed,
-                'campaign': dict(campaign),
-                'customer_id': request['customer_id']
-            }
-    
-    async def reject_stamp_request(self, request_id: int, reason: str = None):
-        async with self.pool.acquire() as conn:
-            request = await conn.fetchrow(
-                'SELECT * FROM stamp_requests WHERE id = $1 AND status = $2',
-                request_id, 'pending'
+                SELECT enrollment_id, merchant_id, 'stamp_added', 1 FROM req
             )
-            
-            if not request:
-                return None
-            
-            await conn.execute('''
-                UPDATE stamp_requests 
-                SET status = 'rejected', rejection_reason = $2, processed_at = NOW()
-                WHERE id = $1
-            ''', request_id, reason)
-            
-            return dict(request)
+            SELECT * FROM enr
+        ''', merchant_id, request_ids)
+        
+        stamps = sum(row['stamps_added'] for row in rows)
+        if stamps:
+            self._count_stamp(merchant_id, stamps)
+        return rows
     
-    async def get_pending_count(self, merchant_id: int) -> int:
-        async with self.pool.acquire() as conn:
-            count = await conn.fetchval('''
-                SELECT COUNT(*) FROM stamp_requests 
-                WHERE merchant_id = $1 AND status = 'pending'
-            ''', merchant_id)
-            return count or 0
+    async def reject_stamp_request(self, request_id: int, merchant_id: int, reason: str = None, conn=None):
+        # The status and merchant checks in WHERE make the claim atomic and scoped to the merchant;
+        # no row back means it wasn't theirs or wasn't pending
+        async with self._acquire(conn) as conn:
+            return await conn.statements['reject_stamp_request'].fetchrow(request_id, merchant_id, reason)
+    
+    async def get_pending_count(self, merchant_id: int, conn=None) -> int:
+        count = self._pending_counts.get(merchant_id)
+        if count is not None:
+            return count
+        # Taken before the query: a NOTIFY arriving mid-query has nothing to pop, yet the count may predate it
+        generation = (self._listener, self._pending_generation[merchant_id])
+        async with self._acquire(conn) as conn:
+            count = await conn.statements['get_pending_count'].fetchval(merchant_id) or 0
+        # A cached count is only safe while the listener is there to invalidate it, and only
+        # if that same listener saw no change for this merchant since before the query
+        if self._listener is not None and generation == (self._listener, self._pending_generation[merchant_id]):
+            self._pending_counts.set(merchant_id, count)
+        return count
     
-    async def queue_notification(self, user_id: int, message: str):
+    async def queue_notifications(self, rows):
+        """Queue many (user_id, message) notifications at once"""
+        rows = list(rows)
+        if not rows:
+            return
         async with self.pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO notifications (user_id, message)
-                VALUES ($1, $2)
-            ''', user_id, message)
+            if len(rows) > 100:
+                # Binary COPY beats per-row INSERTs once the batch is large
+                await conn.copy_records_to_table('notifications', records=rows, columns=['user_id', 'message'])
+            else:
+                await conn.executemany('''
+                    INSERT INTO notifications (user_id, message)
+                    VALUES ($1, $2)
+                ''', rows)
+    
+    async def wait_for_notifications(self, timeout: float):
+        """Return once new notifications are queued, or after timeout regardless"""
+        if self._listener is None:
+            # Nothing will wake us, so fall back to polling
+            timeout = min(timeout, 5)
+        try:
+            await asyncio.wait_for(self._notifications_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._notifications_ready.clear()
     
     async def get_pending_notifications(self, limit: int = 50):
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch('''
-                SELECT * FROM notifications 
-                WHERE sent = FALSE 
-                ORDER BY created_at
-                LIMIT $1
-            ''', limit)
-            return [dict(row) for row in rows]
+        return await self.pool.fetch('''
+            SELECT * FROM notifications 
+            WHERE sent = FALSE 
+            ORDER BY created_at
+            LIMIT $1
+        ''', limit)
     
     async def mark_notification_sent(self, notification_id: int):
-        async with self.pool.acquire() as conn:
-            await conn.execute('UPDATE notifications SET sent = TRUE WHERE id = $1', notification_id)
+        await self.pool.execute('UPDATE notifications SET sent = TRUE WHERE id = $1', notification_id)
     
-    async def get_daily_stats(self, merchant_id: int, date = None):
-        async with self.pool.acquire() as conn:
-            if not date:
-                date = datetime.now().date()
-            
-            row = await conn.fetchrow('''
-                SELECT * FROM daily_stats 
-                WHERE merchant_id = $1 AND date = $2
-            ''', merchant_id, date)
-            
-            return dict(row) if row else {
-                'visits': 0, 'new_customers': 0, 
-                'stamps_given': 0, 'rewards_claimed': 0
-            }
+    async def mark_notifications_sent(self, notification_ids):
+        await self.pool.execute(
+            'UPDATE notifications SET sent = TRUE WHERE id = ANY($1::int[])',
+            list(notification_ids)
+        )
     
     async def get_merchant_settings(self, merchant_id: int):
+        settings = self._settings_cache.get(merchant_id)
+        if settings is not None:
+            return settings
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow('''
                 SELECT * FROM merchant_settings WHERE merchant_id = $1
             ''', merchant_id)
             
             if not row:
-                await conn.execute('''
-                    INSERT INTO merchant_settings (merchant_id) VALUES ($1)
-                ''', merchant_id)
+                # DO UPDATE (not DO NOTHING) so RETURNING yields the row even if another call won the race
                 row = await conn.fetchrow('''
-                    SELECT * FROM merchant_settings WHERE merchant_id = $1
+                    INSERT INTO merchant_settings (merchant_id) VALUES ($1)
+                    ON CONFLICT (merchant_id) DO UPDATE SET merchant_id = EXCLUDED.merchant_id
+                    RETURNING *
                 ''', merchant_id)
-            
-            return dict(row)
+        
+        self._settings_cache.set(merchant_id, row)
+        return row
     
     async def update_merchant_settings(self, merchant_id: int, **kwargs):
+        unknown = kwargs.keys() - MERCHANT_SETTINGS_COLUMNS
+        if unknown:
+            raise ValueError(f"Unknown merchant settings: {', '.join(sorted(unknown))}")
+        if not kwargs:
+            return
+        # Only the fields passed are written, so an explicit None clears a column. The names come from
+        # the whitelist in a fixed order, so each subset always yields the same statement text and
+        # asyncpg's statement cache plans it once
+        columns = [column for column in MERCHANT_SETTINGS_COLUMNS if column in kwargs]
+        assignments = ', '.join(f"{column} = ${i}" for i, column in enumerate(columns, start=2))
+        await self.pool.execute(
+            f'UPDATE merchant_settings SET {assignments} WHERE merchant_id = $1',
+            merchant_id, *(kwargs[column] for column in columns)
+        )
+        self._settings_cache.pop(merchant_id)
+    
+    async def get_user_preferences(self, user_id: int):
+        prefs = self._prefs_cache.get(user_id)
+        if prefs is not None:
+            return prefs
         async with self.pool.acquire() as conn:
-            set_clauses = []
-            values = []
-            idx = 2
-            
-            for key, value in kwargs.items():
-                set_clauses.append(f"{key} = ${idx}")
-                values.append(value)
-                idx += 1
+            row = await conn.fetchrow('SELECT * FROM user_preferences WHERE user_id = $1', user_id)
             
-            if set_clauses:
-                query = f"UPDATE merchant_settings SET {', '.join(set_clauses)} WHERE merchant_id = $1"
-                await conn.execute(query, merchant_id, *values)
+            if not row:
+                row = await conn.fetchrow('''
+                    INSERT INTO user_preferences (user_id) VALUES ($1)
+                    ON CONFLICT (user_id) DO UPDATE SET user_id = EXCLUDED.user_id
+                    RETURNING *
+                ''', user_id)
+        
+        self._prefs_cache.set(user_id, row)
+        return row
+    
+    async def toggle_user_preference(self, user_id: int, name: str):
+        """Flip one preference flag and return its new value"""
+        if name not in USER_PREFERENCE_DEFAULTS:
+            raise ValueError(f"Unknown user preference: {name}")
+        # The name is checked against the whitelist above, so it is safe to interpolate
+        row = await self.pool.fetchrow(f'''
+            UPDATE user_preferences SET {name} = NOT COALESCE({name}, {USER_PREFERENCE_DEFAULTS[name]})
+            WHERE user_id = $1
+            RETURNING *
+        ''', user_id)
+        if row is None:
+            self._prefs_cache.pop(user_id)
+            return None
+        # RETURNING * is the fresh row, so write it through instead of forcing a re-read
+        self._prefs_cache.set(user_id, row)
+        return row[name]
 
 # Add these methods to your existing StampMeDatabase class
     
     async def mark_user_onboarded(self, user_id: int):
         """Mark user as onboarded"""
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE users SET onboarded = TRUE, updated_at = NOW() WHERE id = $1",
-                user_id
-            )
+        await self.pool.execute(
+            "UPDATE users SET onboarded = TRUE, updated_at = NOW() WHERE id = $1",
+            user_id
+        )
+        self.invalidate_user(user_id)
     
     async def get_customer_enrollments(self, customer_id: int):
         """Get all customer enrollments with campaign details"""
-        async with self.pool.acquire() as conn:
-            return await conn.fetch("""
-                SELECT 
-                    e.id as enrollment_id,
-                    e.stamps,
-                    e.completed,
-                    e.created_at,
-                    c.id as campaign_id,
-                    c.name,
-                    c.stamps_needed,
-                    c.category,
-                    c.reward_description,
-                    u.first_name as merchant_name
-                FROM enrollments e
-                JOIN campaigns c ON e.campaign_id = c.id
-                JOIN users u ON c.merchant_id = u.id
-                WHERE e.customer_id = $1
-                ORDER BY e.completed DESC, e.updated_at DESC
-            """, customer_id)
+        # No timestamp columns: the wallet never shows them, so rows skip datetime decoding
+        return await self.pool.fetch("""
+            SELECT 
+                e.id as enrollment_id,
+                e.stamps,
+                e.completed,
+                c.id as campaign_id,
+                c.name,
+                c.stamps_needed,
+                c.category,
+                c.reward_description,
+                u.first_name as merchant_name
+            FROM enrollments e
+            JOIN campaigns c ON e.campaign_id = c.id
+            JOIN users u ON c.merchant_id = u.id
+            WHERE e.customer_id = $1
+            ORDER BY e.completed DESC, e.last_stamp_at DESC NULLS LAST, e.joined_at DESC
+        """, customer_id)
+    
+    async def get_customer_card_counts(self, customer_id: int):
+        """(cards, completed) for a customer, counted in SQL rather than from the full wallet"""
+        row = await self.pool.fetchrow("""
+            SELECT COUNT(*) AS cards, COUNT(*) FILTER (WHERE completed) AS completed
+            FROM enrollments
+            WHERE customer_id = $1
+        """, customer_id)
+        return row['cards'], row['completed']
     
     async def get_daily_stats(self, merchant_id: int, date=None):
         """Get merchant daily statistics"""
-        from datetime import datetime
-        if date is None:
-            date = datetime.now().date()
+        # The day defaults to the database's CURRENT_DATE; half-open ranges keep the
+        # timestamp columns index-friendly where DATE(column) = day would not be
+        stats = await self.pool.fetchrow("""
+            WITH d AS (SELECT COALESCE($2::date, CURRENT_DATE) AS day)
+            SELECT 
+                COUNT(DISTINCT sr.customer_id) as visits,
+                COUNT(*) FILTER (WHERE sr.status = 'approved') as stamps_given,
+                COUNT(DISTINCT rc.id) as rewards_claimed
+            FROM d
+            JOIN stamp_requests sr ON sr.created_at >= d.day AND sr.created_at < d.day + 1
+            JOIN campaigns c ON sr.campaign_id = c.id
+            LEFT JOIN reward_claims rc ON c.id = rc.campaign_id 
+                AND rc.merchant_id = $1 
+                AND rc.claimed_at >= d.day AND rc.claimed_at < d.day + 1
+            WHERE c.merchant_id = $1
+        """, merchant_id, date)
         
-        async with self.pool.acquire() as conn:
-            stats = await conn.fetchrow("""
-                SELECT 
-                    COUNT(DISTINCT sr.customer_id) as visits,
-                    COUNT(*) FILTER (WHERE sr.status = 'approved') as stamps_given,
-                    COUNT(DISTINCT rc.id) as rewards_claimed
+        return {
+            'visits': stats['visits'] or 0,
+            'stamps_given': stats['stamps_given'] or 0,
+            'rewards_claimed': stats['rewards_claimed'] or 0
+        }
+    
+    async def get_daily_summaries(self, date=None):
+        """One row of daily figures per approved merchant that wants a summary"""
+        # A single pass over all merchants; each LATERAL count uses the merchant's own indexes
+        return await self.pool.fetch("""
+            WITH d AS (SELECT COALESCE($1::date, CURRENT_DATE) AS day)
+            SELECT u.id AS merchant_id, v.visits, n.new_customers, r.rewards_claimed, p.pending
+            FROM d
+            CROSS JOIN users u
+            LEFT JOIN merchant_settings ms ON ms.merchant_id = u.id
+            CROSS JOIN LATERAL (
+                SELECT COUNT(DISTINCT sr.customer_id) AS visits
                 FROM stamp_requests sr
-                JOIN campaigns c ON sr.campaign_id = c.id
-                LEFT JOIN reward_claims rc ON c.id = rc.campaign_id 
-                    AND rc.merchant_id = $1 
-                    AND DATE(rc.claimed_at) = $2
-                WHERE c.merchant_id = $1 
-                AND DATE(sr.created_at) = $2
-            """, merchant_id, date)
-            
-            return {
-                'visits': stats['visits'] or 0,
-                'stamps_given': stats['stamps_given'] or 0,
-                'rewards_claimed': stats['rewards_claimed'] or 0
-            }
+                WHERE sr.merchant_id = u.id AND sr.created_at >= d.day AND sr.created_at < d.day + 1
+            ) v
+            CROSS JOIN LATERAL (
+                SELECT COUNT(*) AS new_customers
+                FROM enrollments e
+                JOIN campaigns c ON c.id = e.campaign_id
+                WHERE c.merchant_id = u.id AND e.joined_at >= d.day AND e.joined_at < d.day + 1
+            ) n
+            CROSS JOIN LATERAL (
+                SELECT COUNT(*) AS rewards_claimed
+                FROM reward_claims rc
+                WHERE rc.merchant_id = u.id AND rc.claimed_at >= d.day AND rc.claimed_at < d.day + 1
+            ) r
+            CROSS JOIN LATERAL (
+                SELECT COUNT(*) AS pending
+                FROM stamp_requests sr
+                WHERE sr.merchant_id = u.id AND sr.status = 'pending'
+            ) p
+            WHERE u.user_type = 'merchant' AND u.merchant_approved = TRUE
+              AND COALESCE(ms.daily_summary_enabled, TRUE)
+        """, date)
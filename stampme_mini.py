@@ -1,72 +1,124 @@
-import os
 import asyncio
+import asyncpg
+import hmac
+import re
+import signal
+import time
 import io
-import random
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from datetime import date
 from aiohttp import web
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, ReplyKeyboardMarkup, KeyboardButton
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters, ConversationHandler
-import qrcode
+import segno
 from PIL import Image, ImageDraw, ImageFont
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from database_complete import StampMeDatabase
-from collections import defaultdict
+from config import CONFIG, MESSAGES, MERCHANT_TIPS
+from collections import Counter, defaultdict, deque
 import logging
-
-# Configuration
-TOKEN = os.getenv("BOT_TOKEN")
-BOT_USERNAME = os.getenv("BOT_USERNAME", "stampmebot")
-PORT = int(os.getenv("PORT", 10000))
-DATABASE_URL = os.getenv("DATABASE_URL")
-ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_IDS", "").split(",") if id.strip()]
+import queue
+from logging.handlers import QueueHandler, QueueListener
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Brand Footer
-BRAND_FOOTER = "\n\n💙 _Powered by StampMe_"
+BRAND_FOOTER = CONFIG.brand_footer
 
-# Merchant Tips
-MERCHANT_TIPS = [
-    "Post your QR code near the counter to boost engagement!",
-    "Respond to stamp requests quickly to keep customers happy.",
-    "Add multiple reward tiers to encourage repeat visits.",
-    "Share your referral link on social media!",
-    "Consider running a limited-time bonus stamp promotion!",
-]
+def tip_of_the_day():
+    # Seeded by the date, so every merchant sees the same tip on a given day
+    return MERCHANT_TIPS[date.today().toordinal() % len(MERCHANT_TIPS)]
 
 # Conversation states
 PROGRAM_NAME, PROGRAM_STAMPS, PROGRAM_REWARD, PROGRAM_DESCRIPTION, PROGRAM_CATEGORY = range(5)
 
 # Initialize
-db = StampMeDatabase(DATABASE_URL)
-scheduler = AsyncIOScheduler()
+db = StampMeDatabase(
+    CONFIG.database_url,
+    min_size=CONFIG.db_min_size,
+    max_size=CONFIG.db_max_size,
+    max_queries=CONFIG.db_max_queries,
+    idle_lifetime=CONFIG.db_idle_lifetime,
+    command_timeout=CONFIG.db_command_timeout,
+)
+# Jobs run as coroutines on the bot's event loop; a job still running or delayed past its
+# slot (busy loop, restart) runs once late instead of overlapping or firing twice
+scheduler = AsyncIOScheduler(job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 300})
 
-# Logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Logging: handlers on the event loop only enqueue records; the listener thread writes them out
+_log_queue = queue.SimpleQueue()
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', handlers=[QueueHandler(_log_queue)])
+log_listener = QueueListener(_log_queue, logging.StreamHandler())
+log_listener.start()
 logger = logging.getLogger(__name__)
 
 # ==================== RATE LIMITING ====================
 
 class RateLimiter:
-    def __init__(self):
-        self.requests = defaultdict(list)
+    """Sliding window: `limit` calls per `window` seconds, then the user is held off for `block` seconds"""
+    
+    def __init__(self, limit: int = 30, window: float = 60, block: float = 300):
+        self.limit = limit
+        self.window = window
+        self.block = block
+        self.requests = defaultdict(deque)
         self.blocked_users = {}
     
     def check_rate_limit(self, user_id: int) -> tuple[bool, int]:
-        now = datetime.now()
+        now = time.monotonic()
         if user_id in self.blocked_users:
             if now < self.blocked_users[user_id]:
                 return False, 0
             else:
                 del self.blocked_users[user_id]
-        cutoff = now - timedelta(seconds=60)
-        self.requests[user_id] = [req_time for req_time in self.requests[user_id] if req_time > cutoff]
-        if len(self.requests[user_id]) >= 30:
-            self.blocked_users[user_id] = now + timedelta(minutes=5)
+        requests = self.requests[user_id]
+        # Timestamps go in in order, so the expired ones are all at the front
+        while requests and requests[0] <= now - self.window:
+            requests.popleft()
+        if len(requests) >= self.limit:
+            if self.block:
+                self.blocked_users[user_id] = now + self.block
             return False, 0
-        self.requests[user_id].append(now)
-        remaining = 30 - len(self.requests[user_id])
-        return True, remaining
+        requests.append(now)
+        return True, self.limit - len(requests)
 
 rate_limiter = RateLimiter()
+# Button taps can each cost several queries (approve_all most of all), so they get a tight
+# window of their own; going over just drops the tap rather than blocking the user
+callback_limiter = RateLimiter(limit=5, window=3, block=0)
+
+class TokenBucket:
+    """Async limiter: `async with bucket:` waits until one of `rate` tokens per second is free"""
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def __aenter__(self):
+        # Holding the lock while sleeping queues waiters in order instead of letting them stampede
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    async def __aexit__(self, *exc):
+        return False
+
+# Telegram allows about 30 messages a second per bot; stay a little under it
+send_bucket = TokenBucket(rate=25, burst=30)
 
 # ==================== KEYBOARDS ====================
 
@@ -96,6 +148,7 @@ def get_admin_keyboard():
 
 # ==================== UTILITY FUNCTIONS ====================
 
+@lru_cache(maxsize=512)
 def generate_progress_bar(current: int, total: int, length: int = 10) -> str:
     if total == 0:
         return "░" * length
@@ -103,16 +156,31 @@ def generate_progress_bar(current: int, total: int, length: int = 10) -> str:
     filled = max(0, min(length, filled))
     return "█" * filled + "░" * (length - filled)
 
-def generate_card_image(campaign_name: str, current_stamps: int, needed_stamps: int):
-    width, height = 800, 400
-    img = Image.new('RGB', (width, height), color='#6366f1')
-    draw = ImageDraw.Draw(img)
-    try:
-        title_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 42)
-        text_font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 28)
-    except:
-        title_font = text_font = ImageFont.load_default()
-    draw.text((40, 30), campaign_name[:30], fill='white', font=title_font)
+async def reply_or_edit(update: Update, text: str, **kwargs):
+    """Answer a command with a new message, or a button tap by editing the message it was on"""
+    query = update.callback_query
+    # Only text messages can be edited into text; buttons under a photo get a fresh reply
+    if query and query.message and query.message.text:
+        await query.message.edit_text(text, **kwargs)
+    else:
+        await update.effective_message.reply_text(text, **kwargs)
+
+try:
+    TITLE_FONT = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 42)
+    TEXT_FONT = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 28)
+except OSError:
+    TITLE_FONT = TEXT_FONT = ImageFont.load_default()
+
+# Cards only ever use three colours, so they are drawn as palette images: a third of the
+# memory of RGB and a much smaller, faster PNG. Fills below are indices into this palette.
+CARD_PALETTE = (
+    0x63, 0x66, 0xf1,  # background
+    0xfb, 0xbf, 0x24,  # filled stamp
+    0xff, 0xff, 0xff,  # text and outlines
+)
+CARD_BACKGROUND, CARD_GOLD, CARD_WHITE = range(3)
+
+def _stamp_boxes(needed_stamps: int):
     stamp_size = 55
     spacing = 18
     start_x = 40
@@ -123,95 +191,257 @@ def generate_card_image(campaign_name: str, current_stamps: int, needed_stamps:
         col = i % cols
         x = start_x + col * (stamp_size + spacing)
         y = start_y + row * (stamp_size + spacing)
-        if i < current_stamps:
-            draw.ellipse([x, y, x + stamp_size, y + stamp_size], fill='#fbbf24', outline='white', width=3)
-            draw.text((x + 17, y + 12), "★", fill='white', font=text_font)
-        else:
-            draw.ellipse([x, y, x + stamp_size, y + stamp_size], fill='none', outline='white', width=2)
+        yield x, y, x + stamp_size, y + stamp_size
+
+@lru_cache(maxsize=128)
+def _card_template(campaign_name: str, needed_stamps: int):
+    """Background, title and empty slots, shared by every card of a campaign"""
+    img = Image.new('P', (800, 400), color=CARD_BACKGROUND)
+    img.putpalette(CARD_PALETTE)
+    draw = ImageDraw.Draw(img)
+    draw.text((40, 30), campaign_name[:30], fill=CARD_WHITE, font=TITLE_FONT)
+    for box in _stamp_boxes(needed_stamps):
+        draw.ellipse(box, fill=None, outline=CARD_WHITE, width=2)
+    return img
+
+def generate_card_image(campaign_name: str, current_stamps: int, needed_stamps: int):
+    # Copy the cached template and draw only what depends on the stamp count
+    img = _card_template(campaign_name, needed_stamps).copy()
+    draw = ImageDraw.Draw(img)
+    for i, (x, y, x2, y2) in enumerate(_stamp_boxes(needed_stamps)):
+        if i >= current_stamps:
+            break
+        draw.ellipse([x, y, x2, y2], fill=CARD_GOLD, outline=CARD_WHITE, width=3)
+        draw.text((x + 17, y + 12), "★", fill=CARD_WHITE, font=TEXT_FONT)
     progress_text = f"{current_stamps} / {needed_stamps} stamps"
-    draw.text((40, height - 70), progress_text, fill='white', font=text_font)
+    draw.text((40, img.height - 70), progress_text, fill=CARD_WHITE, font=TEXT_FONT)
     return img
 
+@lru_cache(maxsize=512)
+def card_png(campaign_name: str, current_stamps: int, needed_stamps: int) -> bytes:
+    """PNG bytes for a card; the image depends only on these arguments, so repeats are free"""
+    bio = io.BytesIO()
+    generate_card_image(campaign_name, current_stamps, needed_stamps).save(bio, 'PNG')
+    return bio.getvalue()
+
+@lru_cache(maxsize=1024)
+def qr_png(data: str) -> bytes:
+    """PNG bytes for a QR code; join links and customer IDs never change, so each is drawn once"""
+    # segno picks the smallest symbol itself and writes the PNG directly, without going through Pillow.
+    # A fixed mask skips scoring all eight candidates, most of the build time; any mask scans fine
+    qr = segno.make(data, error='m', mask=0, micro=False)
+    bio = io.BytesIO()
+    # scale 6 keeps the image small; the 4-module quiet zone is the spec minimum printed codes need to scan
+    qr.save(bio, kind='png', scale=6, border=4)
+    return bio.getvalue()
+
+def join_link_for(campaign_id: int) -> str:
+    return f"https://t.me/{CONFIG.bot_username}?start=join_{campaign_id}"
+
+# Pillow releases the GIL while drawing and encoding, so rendering off the loop runs in parallel
+CARD_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='render')
+
+async def render_png(func, *args) -> io.BytesIO:
+    png = await asyncio.get_running_loop().run_in_executor(CARD_EXECUTOR, func, *args)
+    return io.BytesIO(png)
+
 async def health_check(request):
     return web.Response(text="StampMe Bot Running! 💙")
 
-async def start_web_server():
+BOT_APP = web.AppKey("bot_app")
+# No token in the path: request paths end up in access and proxy logs
+WEBHOOK_PATH = "/telegram"
+
+async def telegram_webhook(request):
+    bot_app = request.app[BOT_APP]
+    # The secret_token given to set_webhook keeps anyone but Telegram from posting updates
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, CONFIG.webhook_secret):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    # Queued for the application's own update processing; Telegram gets its 200 straight away
+    await bot_app.update_queue.put(Update.de_json(data, bot_app.bot))
+    return web.Response()
+
+async def start_web_server(bot_app):
+    """Serve health checks and the webhook on PORT; the caller cleans up the returned runner"""
     app = web.Application()
+    app[BOT_APP] = bot_app
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
     app.router.add_get('/healthz', health_check)
+    app.router.add_post(WEBHOOK_PATH, telegram_webhook)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', PORT)
+    site = web.TCPSite(runner, '0.0.0.0', CONFIG.port)
     await site.start()
-    print(f"✅ Health server running on port {PORT}")
+    logger.info(f"✅ Health server running on port {CONFIG.port}")
+    return runner
 
 # ==================== MIGRATIONS ====================
 
+# Indexes built by run_migrations, keyed by name
+MIGRATION_INDEXES = {
+    'idx_campaigns_category': 'campaigns(category)',
+    'idx_campaigns_active': 'campaigns(active)',
+    'idx_transactions_enrollment_created': 'transactions(enrollment_id, created_at)',
+    'idx_enrollments_campaign_stamps': 'enrollments(campaign_id, stamps DESC, joined_at)',
+    'idx_campaigns_merchant_active': 'campaigns(merchant_id, active, created_at DESC)',
+    'idx_reward_tiers_campaign': 'reward_tiers(campaign_id, stamps_required)',
+    'idx_stamp_requests_pending': "stamp_requests(merchant_id, created_at) WHERE status = 'pending'",
+    'idx_enrollments_customer_recent': 'enrollments(customer_id, last_stamp_at DESC NULLS LAST, joined_at DESC) INCLUDE (campaign_id, stamps, completed)',
+    'idx_notifications_unsent': 'notifications(created_at) WHERE sent = FALSE',
+    'idx_users_pending_merchants': "users(created_at) WHERE user_type = 'merchant' AND merchant_approved = FALSE",
+    'idx_users_approved_merchants': "users(id) WHERE user_type = 'merchant' AND merchant_approved = TRUE",
+}
+# Indexes run_migrations drops again. idx_enrollments_customer and idx_enrollments_customer_joined only
+# duplicated the leading customer_id of idx_enrollments_customer_recent, which serves the wallet and card
+# counts on its own; no query orders a customer's cards by joined_at alone
+RETIRED_INDEXES = ('idx_enrollments_customer', 'idx_enrollments_customer_joined')
+
+# Columns (table.column) the DDL in run_migrations adds to the base schema
+MIGRATION_COLUMNS = (
+    'campaigns.category',
+    'campaigns.description',
+    'campaigns.reward_description',
+    'users.onboarded',
+    'users.tutorial_completed',
+)
+
+# NOTIFY triggers StampMeDatabase's listener relies on, keyed by trigger name
+MIGRATION_TRIGGERS = {
+    # Which merchant's pending count changed
+    'stamp_requests_pending_notify': """
+        CREATE OR REPLACE FUNCTION notify_pending_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('pending_changed', OLD.merchant_id::text);
+            ELSE
+                PERFORM pg_notify('pending_changed', NEW.merchant_id::text);
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        CREATE TRIGGER stamp_requests_pending_notify
+            AFTER INSERT OR DELETE OR UPDATE OF status ON stamp_requests
+            FOR EACH ROW EXECUTE FUNCTION notify_pending_changed();
+    """,
+    # New notifications are waiting; once per statement, so a bulk insert wakes the sender once
+    'notifications_new_notify': """
+        CREATE OR REPLACE FUNCTION notify_notifications_new() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('notifications_new', '');
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql;
+        CREATE TRIGGER notifications_new_notify
+            AFTER INSERT ON notifications
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_notifications_new();
+    """,
+}
+
 async def run_migrations(pool):
     try:
         async with pool.acquire() as conn:
-            print("  📝 Running migrations...")
-            await conn.execute("""
-                DO $$ 
-                BEGIN
-                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='campaigns' AND column_name='category') THEN
-                        ALTER TABLE campaigns ADD COLUMN category VARCHAR(50);
-                    END IF;
-                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='campaigns' AND column_name='description') THEN
-                        ALTER TABLE campaigns ADD COLUMN description TEXT;
-                    END IF;
-                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='campaigns' AND column_name='reward_description') THEN
-                        ALTER TABLE campaigns ADD COLUMN reward_description TEXT;
-                    END IF;
-                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='users' AND column_name='onboarded') THEN
-                        ALTER TABLE users ADD COLUMN onboarded BOOLEAN DEFAULT FALSE;
-                    END IF;
-                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='users' AND column_name='tutorial_completed') THEN
-                        ALTER TABLE users ADD COLUMN tutorial_completed BOOLEAN DEFAULT FALSE;
-                    END IF;
-                END $$;
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS user_preferences (
-                    user_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
-                    notification_enabled BOOLEAN DEFAULT TRUE,
-                    marketing_emails BOOLEAN DEFAULT TRUE,
-                    data_sharing BOOLEAN DEFAULT FALSE,
-                    language VARCHAR(10) DEFAULT 'en',
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    updated_at TIMESTAMP DEFAULT NOW()
-                );
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS merchant_settings (
-                    merchant_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
-                    notification_frequency VARCHAR(20) DEFAULT 'immediate',
-                    daily_summary_enabled BOOLEAN DEFAULT TRUE,
-                    auto_approve_trusted BOOLEAN DEFAULT FALSE,
-                    business_hours JSONB,
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    updated_at TIMESTAMP DEFAULT NOW()
-                );
-            """)
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS reward_claims (
-                    id SERIAL PRIMARY KEY,
-                    campaign_id INTEGER REFERENCES campaigns(id) ON DELETE CASCADE,
-                    customer_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
-                    merchant_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
-                    claimed_at TIMESTAMP DEFAULT NOW(),
-                    reward_value TEXT
-                );
-            """)
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_campaigns_category ON campaigns(category);
-                CREATE INDEX IF NOT EXISTS idx_campaigns_active ON campaigns(active);
-                CREATE INDEX IF NOT EXISTS idx_enrollments_customer ON enrollments(customer_id);
-            """)
-            print("  ✅ Migrations complete!")
+            logger.info("📝 Running migrations...")
+            # Checked against the columns and tables themselves: migrate_database.py drops and recreates
+            # the base tables, so a surviving reward_claims doesn't mean the columns are still there
+            migrated = await conn.fetchval("""
+                SELECT to_regclass('reward_claims') IS NOT NULL
+                   AND to_regclass('user_preferences') IS NOT NULL
+                   AND to_regclass('merchant_settings') IS NOT NULL
+                   AND (SELECT COUNT(*) FROM information_schema.columns
+                        WHERE table_schema = current_schema()
+                          AND table_name || '.' || column_name = ANY($1::text[])) = cardinality($1::text[])
+            """, list(MIGRATION_COLUMNS))
+            valid_indexes = {row['relname'] for row in await conn.fetch("""
+                SELECT c.relname FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = ANY($1::text[]) AND i.indisvalid
+            """, list(MIGRATION_INDEXES))}
+            retired = [row['relname'] for row in await conn.fetch(
+                "SELECT relname FROM pg_class WHERE relname = ANY($1::text[]) AND relkind = 'i'", list(RETIRED_INDEXES)
+            )]
+            triggers = {row['tgname'] for row in await conn.fetch(
+                "SELECT tgname FROM pg_trigger WHERE tgname = ANY($1::text[])", list(MIGRATION_TRIGGERS)
+            )}
+            if not migrated:
+                await conn.execute("""
+                    DO $$ 
+                    BEGIN
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='campaigns' AND column_name='category') THEN
+                            ALTER TABLE campaigns ADD COLUMN category VARCHAR(50);
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='campaigns' AND column_name='description') THEN
+                            ALTER TABLE campaigns ADD COLUMN description TEXT;
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='campaigns' AND column_name='reward_description') THEN
+                            ALTER TABLE campaigns ADD COLUMN reward_description TEXT;
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='users' AND column_name='onboarded') THEN
+                            ALTER TABLE users ADD COLUMN onboarded BOOLEAN DEFAULT FALSE;
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='users' AND column_name='tutorial_completed') THEN
+                            ALTER TABLE users ADD COLUMN tutorial_completed BOOLEAN DEFAULT FALSE;
+                        END IF;
+                    END $$;
+                """)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS user_preferences (
+                        user_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+                        notification_enabled BOOLEAN DEFAULT TRUE,
+                        marketing_emails BOOLEAN DEFAULT TRUE,
+                        data_sharing BOOLEAN DEFAULT FALSE,
+                        language VARCHAR(10) DEFAULT 'en',
+                        created_at TIMESTAMP DEFAULT NOW(),
+                        updated_at TIMESTAMP DEFAULT NOW()
+                    );
+                """)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS merchant_settings (
+                        merchant_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+                        notification_frequency VARCHAR(20) DEFAULT 'immediate',
+                        daily_summary_enabled BOOLEAN DEFAULT TRUE,
+                        auto_approve_trusted BOOLEAN DEFAULT FALSE,
+                        business_hours JSONB,
+                        created_at TIMESTAMP DEFAULT NOW(),
+                        updated_at TIMESTAMP DEFAULT NOW()
+                    );
+                """)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS reward_claims (
+                        id SERIAL PRIMARY KEY,
+                        campaign_id INTEGER REFERENCES campaigns(id) ON DELETE CASCADE,
+                        customer_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+                        merchant_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
+                        claimed_at TIMESTAMP DEFAULT NOW(),
+                        reward_value TEXT
+                    );
+                """)
+                # Statements prepared before the ALTERs above describe the old row shape
+                await pool.expire_connections()
+            # Checked on their own so databases migrated before a trigger existed pick it up too
+            for name, ddl in MIGRATION_TRIGGERS.items():
+                if name not in triggers:
+                    await conn.execute(ddl)
+        missing = [name for name in MIGRATION_INDEXES if name not in valid_indexes]
+        if missing or retired:
+            # CONCURRENTLY can't run inside a transaction or alongside other statements,
+            # so build one index at a time on a connection that holds no pool slot
+            conn = await asyncpg.connect(CONFIG.database_url)
+            try:
+                for name in retired:
+                    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                for name in missing:
+                    # An interrupted concurrent build leaves an invalid index behind
+                    await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                    await conn.execute(f"CREATE INDEX CONCURRENTLY {name} ON {MIGRATION_INDEXES[name]}")
+            finally:
+                await conn.close()
+        logger.info("✅ Migrations complete!")
     except Exception as e:
-        print(f"  ⚠️ Migration error: {e}")
+        logger.exception(f"Migration error: {e}")
 
 # ==================== SETTINGS ====================
 
@@ -219,11 +449,7 @@ async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user = await db.get_user(user_id)
     try:
-        async with db.pool.acquire() as conn:
-            prefs = await conn.fetchrow("SELECT * FROM user_preferences WHERE user_id = $1", user_id)
-            if not prefs:
-                await conn.execute("INSERT INTO user_preferences (user_id) VALUES ($1) ON CONFLICT (user_id) DO NOTHING", user_id)
-                prefs = await conn.fetchrow("SELECT * FROM user_preferences WHERE user_id = $1", user_id)
+        prefs = await db.get_user_preferences(user_id)
     except Exception as e:
         logger.error(f"Error getting preferences: {e}")
         prefs = {'notification_enabled': True, 'marketing_emails': True, 'data_sharing': False}
@@ -243,10 +469,7 @@ async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     message = f"⚙️ *Settings*\n\nUser ID: `{user_id}`\nAccount Type: {user['user_type'].title()}\n\nConfigure your preferences below:"
     
-    if update.callback_query:
-        await update.callback_query.message.edit_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-    else:
-        await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    await reply_or_edit(update, message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
 # ==================== NEW PROGRAM WIZARD ====================
 
@@ -343,14 +566,8 @@ async def program_description_received(update: Update, context: ContextTypes.DEF
             category=context.user_data.get('category'),
             description=description
         )
-        join_link = f"https://t.me/{BOT_USERNAME}?start=join_{campaign_id}"
-        qr = qrcode.QRCode(version=1, box_size=10, border=4)
-        qr.add_data(join_link)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        bio = io.BytesIO()
-        img.save(bio, 'PNG')
-        bio.seek(0)
+        join_link = join_link_for(campaign_id)
+        bio = await render_png(qr_png, join_link)
         keyboard = [
             [InlineKeyboardButton("📤 Share Link", url=join_link)],
             [InlineKeyboardButton("📋 View My Programs", callback_data="view_my_programs")]
@@ -382,67 +599,41 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     user = await db.get_user(user_id)
     allowed, remaining = rate_limiter.check_rate_limit(user_id)
     if not allowed:
-        keyboard = get_admin_keyboard() if user_id in ADMIN_IDS else (get_customer_keyboard() if user and user['user_type'] == 'customer' else get_merchant_keyboard())
+        keyboard = get_admin_keyboard() if user_id in CONFIG.admin_ids else (get_customer_keyboard() if user and user['user_type'] == 'customer' else get_merchant_keyboard())
         await update.message.reply_text("⚠️ Please slow down! Wait a moment.", reply_markup=keyboard)
         return
     
-    if user_id in ADMIN_IDS:
-        if text == "👑 Admin Panel":
-            await admin_panel(update, context)
-            return
-        elif text == "📊 System Stats":
-            await system_stats(update, context)
-            return
-        elif text == "🏪 Manage Merchants":
-            await manage_merchants(update, context)
-            return
-    
-    if text == "💳 My Wallet":
-        await wallet(update, context)
-    elif text == "📍 Find Stores":
-        await find_stores(update, context)
-    elif text == "🆔 Show My ID":
-        await myid(update, context)
-    elif text == "🎁 My Rewards":
-        await show_rewards(update, context)
-    elif text == "⚙️ Settings":
-        await settings_menu(update, context)
-    elif text == "❓ Help":
-        await help_command(update, context)
-    elif text == "📊 Dashboard":
-        await dashboard(update, context)
-    elif text == "⏳ Pending":
-        await pending(update, context)
-    elif text == "📸 Scan Customer":
-        await scan_customer_menu(update, context)
-    elif text == "📋 My Programs":
-        await mycampaigns(update, context)
-    elif text == "➕ New Program":
-        await new_program_start(update, context)
+    handler = ADMIN_MENU_ACTIONS.get(text) if user_id in CONFIG.admin_ids else None
+    handler = handler or MENU_ACTIONS.get(text)
+    if handler:
+        await handler(update, context)
     else:
-        keyboard = get_admin_keyboard() if user_id in ADMIN_IDS else (get_customer_keyboard() if user and user['user_type'] == 'customer' else get_merchant_keyboard())
+        keyboard = get_admin_keyboard() if user_id in CONFIG.admin_ids else (get_customer_keyboard() if user and user['user_type'] == 'customer' else get_merchant_keyboard())
         await update.message.reply_text("👆 Please use the menu buttons below!", reply_markup=keyboard)
 
 # ==================== COMMAND HANDLERS ====================
 
+# /start payload of a program's share link: join_<campaign_id>
+JOIN_LINK_RE = re.compile(r'join_(\d+)')
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username
     first_name = update.effective_user.first_name
     await db.create_or_update_user(user_id, username, first_name)
     user = await db.get_user(user_id)
-    is_admin = user_id in ADMIN_IDS
+    is_admin = user_id in CONFIG.admin_ids
     
     if context.args:
-        arg = context.args[0]
-        if arg.startswith("join_"):
+        join_link = JOIN_LINK_RE.fullmatch(context.args[0])
+        if join_link:
+            campaign_id = int(join_link.group(1))
             try:
-                campaign_id = int(arg.split("_")[1])
-                campaign = await db.get_campaign(campaign_id)
+                # Independent lookups, so they share one round trip's worth of latency
+                campaign, enrollment = await asyncio.gather(db.get_campaign(campaign_id), db.get_enrollment(campaign_id, user_id))
                 if not campaign or not campaign['active']:
                     await update.message.reply_text("😕 This program is no longer available" + BRAND_FOOTER, reply_markup=get_customer_keyboard(), parse_mode="Markdown")
                     return
-                enrollment = await db.get_enrollment(campaign_id, user_id)
                 if not enrollment:
                     await db.enroll_customer(campaign_id, user_id)
                     keyboard = [[InlineKeyboardButton("⭐ Request First Stamp", callback_data=f"request_{campaign_id}")]]
@@ -481,11 +672,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await db.mark_user_onboarded(user_id)
         else:
             try:
-                enrollments = await db.get_customer_enrollments(user_id)
-                completed = sum(1 for e in enrollments if e.get('completed', False))
+                cards, completed = await db.get_customer_card_counts(user_id)
                 message = f"👋 Welcome back, {first_name}!\n\n"
-                if enrollments:
-                    message += f"📊 *Quick Stats:*\n• {len(enrollments)} active cards\n"
+                if cards:
+                    message += f"📊 *Quick Stats:*\n• {cards} active cards\n"
                     if completed > 0:
                         message += f"• 🎁 {completed} rewards ready!\n"
                     message += "\n"
@@ -495,55 +685,138 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.error(f"Error getting enrollments: {e}")
                 await update.message.reply_text(f"👋 Welcome back, {first_name}!\n\nUse the menu below 👇" + BRAND_FOOTER, reply_markup=get_customer_keyboard(), parse_mode="Markdown")
 
+async def request_merchant(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id in CONFIG.admin_ids:
+        await update.message.reply_text("👑 Admins don't need a merchant account." + BRAND_FOOTER, parse_mode="Markdown")
+        return
+    user = await db.get_user(user_id)
+    if user and user['user_type'] == 'merchant':
+        if user.get('merchant_approved', False):
+            await update.message.reply_text("✅ You're already an approved merchant!" + BRAND_FOOTER, reply_markup=get_merchant_keyboard(), parse_mode="Markdown")
+        else:
+            await update.message.reply_text("🏪 *Merchant Application Pending*\n\nYour account is being reviewed.\nYou'll be notified within 24 hours!" + BRAND_FOOTER, parse_mode="Markdown")
+        return
+    name = update.effective_user.first_name or update.effective_user.username or str(user_id)
+    try:
+        # One statement marks the application and queues a notification for every admin
+        await db.request_merchant_access(user_id, CONFIG.admin_ids, MESSAGES['merchant_application'](name=name, user_id=user_id))
+        await update.message.reply_text("🏪 *Merchant Application Sent*\n\nYour account is being reviewed.\nYou'll be notified within 24 hours!" + BRAND_FOOTER, parse_mode="Markdown")
+    except Exception as e:
+        logger.error(f"Error requesting merchant access: {e}")
+        await update.message.reply_text("❌ Error sending application. Please try again later." + BRAND_FOOTER, parse_mode="Markdown")
+
+# Help never changes, so the text (footer included) and keyboards are built once at import
+MERCHANT_HELP_TEXT = "❓ *Merchant Help*\n\nChoose a topic or use the menu buttons below 👇" + BRAND_FOOTER
+MERCHANT_HELP_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("📖 Getting Started", callback_data="help_merchant_start")], [InlineKeyboardButton("⭐ Managing Stamps", callback_data="help_stamps")], [InlineKeyboardButton("💡 Best Practices", callback_data="help_tips")]])
+CUSTOMER_HELP_TEXT = "❓ *Help Center*\n\n*Quick Guide:*\n• Tap 💳 My Wallet to see your cards\n• Tap 🆔 Show My ID at checkout\n• Tap 📍 Find Stores to discover shops\n\nUse the menu buttons below for quick access!" + BRAND_FOOTER
+CUSTOMER_HELP_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🎯 How to Collect Stamps", callback_data="help_customer_stamps")], [InlineKeyboardButton("🎁 How to Claim Rewards", callback_data="help_rewards")], [InlineKeyboardButton("🆔 Using Your ID", callback_data="help_id")]])
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = await db.get_user(update.effective_user.id)
     if user and user['user_type'] == 'merchant' and user.get('merchant_approved', False):
-        keyboard = [[InlineKeyboardButton("📖 Getting Started", callback_data="help_merchant_start")], [InlineKeyboardButton("⭐ Managing Stamps", callback_data="help_stamps")], [InlineKeyboardButton("💡 Best Practices", callback_data="help_tips")]]
-        message = "❓ *Merchant Help*\n\nChoose a topic or use the menu buttons below 👇"
+        await update.message.reply_text(MERCHANT_HELP_TEXT, reply_markup=MERCHANT_HELP_MARKUP, parse_mode="Markdown")
     else:
-        keyboard = [[InlineKeyboardButton("🎯 How to Collect Stamps", callback_data="help_customer_stamps")], [InlineKeyboardButton("🎁 How to Claim Rewards", callback_data="help_rewards")], [InlineKeyboardButton("🆔 Using Your ID", callback_data="help_id")]]
-        message = "❓ *Help Center*\n\n*Quick Guide:*\n• Tap 💳 My Wallet to see your cards\n• Tap 🆔 Show My ID at checkout\n• Tap 📍 Find Stores to discover shops\n\nUse the menu buttons below for quick access!"
-    await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await update.message.reply_text(CUSTOMER_HELP_TEXT, reply_markup=CUSTOMER_HELP_MARKUP, parse_mode="Markdown")
+
+# Cards rendered per wallet page; further pages are fetched with wallet_page_<n> buttons
+WALLET_PAGE_SIZE = 5
 
-async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     user_id = update.effective_user.id
+    # effective_message, so the page buttons (callback queries) can reply the same way
+    message = update.effective_message
     enrollments = await db.get_customer_enrollments(user_id)
     if not enrollments:
         keyboard = [[InlineKeyboardButton("🔍 Find Stores", callback_data="find_stores_wallet")]]
-        await update.message.reply_text("💳 *Your Wallet is Empty*\n\nStart collecting loyalty cards from your favorite stores!" + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await message.reply_text("💳 *Your Wallet is Empty*\n\nStart collecting loyalty cards from your favorite stores!" + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
         return
-    await update.message.reply_text(f"💳 *Your Wallet* ({len(enrollments)} cards)" + BRAND_FOOTER, parse_mode="Markdown")
-    for e in enrollments:
-        try:
-            img = generate_card_image(e['name'], e['stamps'], e['stamps_needed'])
-            bio = io.BytesIO()
-            img.save(bio, 'PNG')
-            bio.seek(0)
+    pages = -(-len(enrollments) // WALLET_PAGE_SIZE)
+    page = max(0, min(page, pages - 1))
+    visible = enrollments[page * WALLET_PAGE_SIZE:(page + 1) * WALLET_PAGE_SIZE]
+    renders = []
+    try:
+        # Only this page is rendered; the renders start on the pool while the rest is prepared
+        renders = [asyncio.ensure_future(render_png(card_png, e['name'], e['stamps'], e['stamps_needed'])) for e in visible]
+        await message.chat.send_action(ChatAction.UPLOAD_PHOTO)
+        captions = []
+        keyboard = []
+        for e in visible:
             progress_bar = generate_progress_bar(e['stamps'], e['stamps_needed'], 20)
-            keyboard = []
             if e['completed']:
-                caption = f"🎉 *{e['name']}*\n\n{progress_bar}\n✅ REWARD READY!"
-                keyboard.append([InlineKeyboardButton("🎁 Claim Reward", callback_data=f"claim_reward_{e['campaign_id']}")])
+                captions.append(f"🎉 *{e['name']}*\n\n{progress_bar}\n✅ REWARD READY!")
+                keyboard.append([InlineKeyboardButton(f"🎁 Claim Reward: {e['name']}", callback_data=f"claim_reward_{e['campaign_id']}")])
             else:
-                caption = f"📋 *{e['name']}*\n\n{progress_bar}\n{e['stamps']}/{e['stamps_needed']} stamps"
-                keyboard.append([InlineKeyboardButton("⭐ Request Stamp", callback_data=f"request_{e['campaign_id']}")])
-            reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
-            await update.message.reply_photo(photo=bio, caption=caption + BRAND_FOOTER, parse_mode="Markdown", reply_markup=reply_markup)
-        except Exception as e:
-            logger.error(f"Error generating card: {e}")
+                captions.append(f"📋 *{e['name']}*\n\n{progress_bar}\n{e['stamps']}/{e['stamps_needed']} stamps")
+                keyboard.append([InlineKeyboardButton(f"⭐ Request Stamp: {e['name']}", callback_data=f"request_{e['campaign_id']}")])
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("« Prev", callback_data=f"wallet_page_{page - 1}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("Next »", callback_data=f"wallet_page_{page + 1}"))
+        if nav:
+            keyboard.append(nav)
+        # A card that fails to render is left out of the album; its button still goes on the summary
+        batch = []
+        for e, bio, caption in zip(visible, await asyncio.gather(*renders, return_exceptions=True), captions):
+            if isinstance(bio, Exception):
+                logger.error(f"Error rendering card {e['campaign_id']}: {bio}")
+            else:
+                batch.append((bio, caption))
+        # Albums need 2-10 photos and can't carry buttons, so every card's button
+        # goes on the summary message after them
+        if len(batch) == 1:
+            bio, caption = batch[0]
+            await message.reply_photo(photo=bio, caption=caption, parse_mode="Markdown")
+        elif batch:
+            await message.reply_media_group(media=[InputMediaPhoto(media=bio, caption=caption, parse_mode="Markdown") for bio, caption in batch])
+        header = f"💳 *Your Wallet* ({len(enrollments)} cards)"
+        if pages > 1:
+            header += f" · page {page + 1}/{pages}"
+        await message.reply_text(header + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    except Exception as e:
+        # Renders still running when something failed are not awaited anywhere else
+        for r in renders:
+            r.cancel()
+        logger.error(f"Error sending wallet: {e}")
+        await message.reply_text("❌ Error loading wallet." + BRAND_FOOTER, parse_mode="Markdown")
 
 async def myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    qr = qrcode.QRCode(version=1, box_size=10, border=4)
-    qr.add_data(str(user_id))
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    bio = io.BytesIO()
-    img.save(bio, 'PNG')
-    bio.seek(0)
+    bio = await render_png(qr_png, str(user_id))
     keyboard = [[InlineKeyboardButton("💳 View My Wallet", callback_data="view_wallet")], [InlineKeyboardButton("📍 Find Stores", callback_data="find_stores")]]
     await update.message.reply_photo(photo=bio, caption=f"🆔 *Your Customer ID*\n\nID: `{user_id}`\n\nShow this QR code to merchants when checking out!" + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
+# campaign_id -> Telegram file_id of its uploaded QR code; resending by file_id uploads nothing
+QR_FILE_IDS: dict[int, str] = {}
+
+async def getqr(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Usage: `/getqr <campaign_id>`\n\nExample: `/getqr 1`" + BRAND_FOOTER, parse_mode="Markdown")
+        return
+    campaign_id = int(context.args[0])
+    campaign = await db.get_campaign(campaign_id)
+    if not campaign or campaign['merchant_id'] != user_id:
+        await update.message.reply_text("❌ Campaign not found or you don't own it!" + BRAND_FOOTER, parse_mode="Markdown")
+        return
+    # The join link is fixed by the campaign id, so qr_png's cache already holds one PNG per program
+    # and edits to the program never need to evict it
+    join_link = join_link_for(campaign_id)
+    keyboard = [[InlineKeyboardButton("📤 Share Link", url=join_link)]]
+    caption = f"📱 *{campaign['name']}*\n\n🔗 `{join_link}`\n\n👆 Print this QR code and display it in your store!" + BRAND_FOOTER
+    file_id = QR_FILE_IDS.get(campaign_id)
+    if file_id:
+        try:
+            await update.message.reply_photo(photo=file_id, caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            return
+        except BadRequest:
+            # Telegram no longer recognises it; upload afresh below
+            QR_FILE_IDS.pop(campaign_id, None)
+    bio = await render_png(qr_png, join_link)
+    sent = await update.message.reply_photo(photo=bio, caption=caption, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    QR_FILE_IDS[campaign_id] = sent.photo[-1].file_id
+
 async def show_rewards(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
@@ -552,11 +825,12 @@ async def show_rewards(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not completed:
             await update.message.reply_text("🎁 *No Rewards Ready Yet*\n\nKeep collecting stamps to unlock rewards!\nCheck your wallet to see your progress." + BRAND_FOOTER, parse_mode="Markdown")
             return
-        message = f"🎁 *Your Rewards* ({len(completed)} ready!)\n\n"
+        parts = [f"🎁 *Your Rewards* ({len(completed)} ready!)\n\n"]
         keyboard = []
         for reward in completed:
-            message += f"✅ *{reward['name']}*\n🎯 {reward['stamps']}/{reward['stamps_needed']} stamps\n🎁 Reward: {reward.get('reward_description', 'Prize!')}\n\n"
+            parts.append(f"✅ *{reward['name']}*\n🎯 {reward['stamps']}/{reward['stamps_needed']} stamps\n🎁 Reward: {reward.get('reward_description', 'Prize!')}\n\n")
             keyboard.append([InlineKeyboardButton(f"🎉 Claim: {reward['name'][:20]}", callback_data=f"claim_reward_{reward['campaign_id']}")])
+        message = "".join(parts)
         await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error getting rewards: {e}")
@@ -564,90 +838,95 @@ async def show_rewards(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def find_stores(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        async with db.pool.acquire() as conn:
-            stores = await conn.fetch("SELECT DISTINCT u.id, u.first_name, u.username, c.category, COUNT(c.id) as program_count FROM users u JOIN campaigns c ON c.merchant_id = u.id WHERE u.user_type = 'merchant' AND u.merchant_approved = TRUE AND c.active = TRUE GROUP BY u.id, u.first_name, u.username, c.category ORDER BY program_count DESC LIMIT 15")
+        stores = await db.get_participating_stores()
         if not stores:
-            await update.message.reply_text("🔍 *Find Stores*\n\nNo participating stores yet.\nCheck back soon for new merchants!" + BRAND_FOOTER, parse_mode="Markdown")
+            await reply_or_edit(update, "🔍 *Find Stores*\n\nNo participating stores yet.\nCheck back soon for new merchants!" + BRAND_FOOTER, parse_mode="Markdown")
             return
-        message = f"🔍 *Participating Stores* ({len(stores)})\n\n"
+        parts = [f"🔍 *Participating Stores* ({len(stores)})\n\n"]
         keyboard = []
         for store in stores:
             store_name = store['first_name'] or store['username'] or f"Store {store['id']}"
             category = store.get('category', 'General')
             program_count = store['program_count']
-            message += f"🏪 *{store_name}*\n📁 {category} • {program_count} program(s)\n\n"
+            parts.append(f"🏪 *{store_name}*\n📁 {category} • {program_count} program(s)\n\n")
             keyboard.append([InlineKeyboardButton(f"View: {store_name[:25]}", callback_data=f"view_store_{store['id']}")])
-        await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        message = "".join(parts)
+        await reply_or_edit(update, message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error finding stores: {e}")
-        await update.message.reply_text("❌ Error loading stores." + BRAND_FOOTER, parse_mode="Markdown")
+        await reply_or_edit(update, "❌ Error loading stores." + BRAND_FOOTER, parse_mode="Markdown")
 
 async def dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user = await db.get_user(user_id)
     if not user or user['user_type'] != 'merchant' or not user.get('merchant_approved', False):
-        await update.message.reply_text("❌ Only approved merchants can view dashboard!" + BRAND_FOOTER, parse_mode="Markdown")
+        await reply_or_edit(update, "❌ Only approved merchants can view dashboard!" + BRAND_FOOTER, parse_mode="Markdown")
         return
     try:
-        async with db.pool.acquire() as conn:
-            total_programs = await conn.fetchval("SELECT COUNT(*) FROM campaigns WHERE merchant_id = $1", user_id)
-            active_programs = await conn.fetchval("SELECT COUNT(*) FROM campaigns WHERE merchant_id = $1 AND active = TRUE", user_id)
-            total_enrollments = await conn.fetchval("SELECT COUNT(*) FROM enrollments e JOIN campaigns c ON e.campaign_id = c.id WHERE c.merchant_id = $1", user_id)
-            completed_cards = await conn.fetchval("SELECT COUNT(*) FROM enrollments e JOIN campaigns c ON e.campaign_id = c.id WHERE c.merchant_id = $1 AND e.completed = TRUE", user_id)
+        # Independent reads, each on its own pool connection, so the dashboard waits for the slowest only
+        totals, pending_count, today = await asyncio.gather(
+            db.get_merchant_totals(user_id),
+            db.get_pending_count(user_id),
+            db.get_daily_stats(user_id),
+        )
         keyboard = [[InlineKeyboardButton("⏳ View Pending", callback_data="view_pending_dashboard")], [InlineKeyboardButton("📋 My Programs", callback_data="view_programs_dashboard")]]
-        tip = random.choice(MERCHANT_TIPS)
-        message = f"📊 *Merchant Dashboard*\n\n*Overview:*\n• Programs: {total_programs} ({active_programs} active)\n• Total Customers: {total_enrollments}\n• Completed Cards: {completed_cards}\n\n💡 *Tip:* {tip}"
-        await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        tip = tip_of_the_day()
+        message = f"📊 *Merchant Dashboard*\n\n*Overview:*\n• Programs: {totals['programs']} ({totals['active_programs']} active)\n• Total Customers: {totals['customers']}\n• Stamps Given: {totals['stamps']}\n• Completed Cards: {totals['completed']}\n\n*Today:*\n• Visits: {today['visits']}\n• Stamps: {today['stamps_given']}\n• ⏳ Pending: {pending_count}\n\n💡 *Tip:* {tip}"
+        await reply_or_edit(update, message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error getting dashboard: {e}")
-        await update.message.reply_text("❌ Error loading dashboard." + BRAND_FOOTER, parse_mode="Markdown")
+        await reply_or_edit(update, "❌ Error loading dashboard." + BRAND_FOOTER, parse_mode="Markdown")
 
 async def pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user = await db.get_user(user_id)
     if not user or user['user_type'] != 'merchant' or not user.get('merchant_approved', False):
-        await update.message.reply_text("❌ Only approved merchants can view pending requests!" + BRAND_FOOTER, parse_mode="Markdown")
+        await reply_or_edit(update, "❌ Only approved merchants can view pending requests!" + BRAND_FOOTER, parse_mode="Markdown")
         return
     try:
-        pending_requests = await db.get_pending_requests(user_id)
+        pending_requests, total_pending = await db.get_pending_requests(user_id, limit=10)
         if not pending_requests:
-            await update.message.reply_text("⏳ *No Pending Requests*\n\nAll caught up! 🎉" + BRAND_FOOTER, parse_mode="Markdown")
+            await reply_or_edit(update, "⏳ *No Pending Requests*\n\nAll caught up! 🎉" + BRAND_FOOTER, parse_mode="Markdown")
             return
-        message = f"⏳ *Pending Requests* ({len(pending_requests)})\n\n"
+        parts = [f"⏳ *Pending Requests* ({total_pending})\n\n"]
         keyboard = []
-        for req in pending_requests[:10]:
+        for req in pending_requests:
             customer_name = req.get('customer_name', f"User {req['customer_id']}")
             campaign_name = req.get('campaign_name', 'Unknown')
-            message += f"👤 {customer_name}\n📋 {campaign_name}\n⏰ {req.get('created_at', 'N/A')}\n\n"
+            parts.append(f"👤 {customer_name}\n📋 {campaign_name}\n⏰ {req.get('created_at', 'N/A')}\n\n")
             keyboard.append([InlineKeyboardButton(f"✅ Approve: {customer_name[:15]}", callback_data=f"approve_stamp_{req['id']}"), InlineKeyboardButton("❌ Deny", callback_data=f"deny_stamp_{req['id']}")])
-        if len(pending_requests) > 10:
-            message += f"_...and {len(pending_requests) - 10} more_"
-        await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        if total_pending > len(pending_requests):
+            parts.append(f"_...and {total_pending - len(pending_requests)} more_")
+        if total_pending > 1:
+            keyboard.append([InlineKeyboardButton(f"✅ Approve All ({total_pending})", callback_data="approve_all")])
+        message = "".join(parts)
+        await reply_or_edit(update, message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error getting pending requests: {e}")
-        await update.message.reply_text("❌ Error loading pending requests." + BRAND_FOOTER, parse_mode="Markdown")
+        await reply_or_edit(update, "❌ Error loading pending requests." + BRAND_FOOTER, parse_mode="Markdown")
 
 async def mycampaigns(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user = await db.get_user(user_id)
     if not user or user['user_type'] != 'merchant' or not user.get('merchant_approved', False):
-        await update.message.reply_text("❌ Only approved merchants can view programs!" + BRAND_FOOTER, parse_mode="Markdown")
+        await reply_or_edit(update, "❌ Only approved merchants can view programs!" + BRAND_FOOTER, parse_mode="Markdown")
         return
     try:
-        campaigns = await db.get_merchant_campaigns(user_id)
+        campaigns = await db.get_merchant_campaign_summaries(user_id)
         if not campaigns:
             keyboard = [[InlineKeyboardButton("➕ Create First Program", callback_data="create_first_program")]]
-            await update.message.reply_text("📋 *Your Programs*\n\nYou haven't created any programs yet.\nStart now to attract customers!" + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+            await reply_or_edit(update, "📋 *Your Programs*\n\nYou haven't created any programs yet.\nStart now to attract customers!" + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
             return
-        message = f"📋 *Your Programs* ({len(campaigns)})\n\n"
+        parts = [f"📋 *Your Programs* ({len(campaigns)})\n\n"]
         for camp in campaigns[:10]:
             status = "✅ Active" if camp.get('active', True) else "⏸️ Paused"
-            message += f"*{camp['name']}*\n• {status} • {camp['stamps_needed']} stamps\n• Reward: {camp.get('reward_description', 'N/A')}\n\n"
+            parts.append(f"*{camp['name']}*\n• {status} • {camp['stamps_needed']} stamps\n• Reward: {camp.get('reward_description', 'N/A')}\n• 👥 {camp['customer_count']} customers • 🎉 {camp['completed_count']} completed\n\n")
+        message = "".join(parts)
         keyboard = [[InlineKeyboardButton("➕ Create New Program", callback_data="create_new_program")]]
-        await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await reply_or_edit(update, message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error getting campaigns: {e}")
-        await update.message.reply_text("❌ Error loading programs." + BRAND_FOOTER, parse_mode="Markdown")
+        await reply_or_edit(update, "❌ Error loading programs." + BRAND_FOOTER, parse_mode="Markdown")
 
 async def scan_customer_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -671,23 +950,25 @@ async def givestamp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         customer_id = int(context.args[0])
         campaign_id = int(context.args[1])
-        campaign = await db.get_campaign(campaign_id)
-        if not campaign or campaign['merchant_id'] != user_id:
+        # One connection for the lookups and the stamp; replies go out after it's released
+        async with db.session() as conn:
+            campaign = await db.get_campaign(campaign_id, conn=conn)
+            owned = campaign is not None and campaign['merchant_id'] == user_id
+            enrollment = await db.get_enrollment(campaign_id, customer_id, conn=conn) if owned else None
+            new_enrollment = await db.add_stamp_and_check(enrollment['id'], user_id, conn=conn) if enrollment else None
+        if not owned:
             await update.message.reply_text("❌ Campaign not found or you don't own it!" + BRAND_FOOTER, parse_mode="Markdown")
             return
-        enrollment = await db.get_enrollment(campaign_id, customer_id)
         if not enrollment:
             await update.message.reply_text("❌ Customer not enrolled in this program!" + BRAND_FOOTER, parse_mode="Markdown")
             return
-        await db.add_stamp(campaign_id, customer_id)
-        new_enrollment = await db.get_enrollment(campaign_id, customer_id)
         progress_bar = generate_progress_bar(new_enrollment['stamps'], campaign['stamps_needed'], 20)
         message = f"✅ *Stamp Given!*\n\nCustomer: `{customer_id}`\nProgram: {campaign['name']}\n\n{progress_bar}\n{new_enrollment['stamps']}/{campaign['stamps_needed']} stamps"
-        if new_enrollment.get('completed'):
+        if new_enrollment['completed']:
             message += "\n\n🎉 *CARD COMPLETED!* Customer earned a reward!"
         await update.message.reply_text(message + BRAND_FOOTER, parse_mode="Markdown")
         try:
-            await context.bot.send_message(chat_id=customer_id, text=f"⭐ *New Stamp!*\n\nYou received a stamp from {campaign['name']}!\n\n{progress_bar}\n{new_enrollment['stamps']}/{campaign['stamps_needed']} stamps" + ("\n\n🎉 *REWARD READY!* Check 🎁 My Rewards" if new_enrollment.get('completed') else "") + BRAND_FOOTER, parse_mode="Markdown")
+            await context.bot.send_message(chat_id=customer_id, text=f"⭐ *New Stamp!*\n\nYou received a stamp from {campaign['name']}!\n\n{progress_bar}\n{new_enrollment['stamps']}/{campaign['stamps_needed']} stamps" + ("\n\n🎉 *REWARD READY!* Check 🎁 My Rewards" if new_enrollment['completed'] else "") + BRAND_FOOTER, parse_mode="Markdown")
         except:
             pass
     except ValueError:
@@ -698,17 +979,19 @@ async def givestamp(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS:
+    if user_id not in CONFIG.admin_ids:
         await update.message.reply_text("❌ Access denied!" + BRAND_FOOTER, parse_mode="Markdown")
         return
     try:
-        async with db.pool.acquire() as conn:
-            total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-            total_merchants = await conn.fetchval("SELECT COUNT(*) FROM users WHERE user_type = 'merchant'")
-            pending_merchants = await conn.fetchval("SELECT COUNT(*) FROM users WHERE user_type = 'merchant' AND merchant_approved = FALSE")
-            total_campaigns = await conn.fetchval("SELECT COUNT(*) FROM campaigns")
-            active_campaigns = await conn.fetchval("SELECT COUNT(*) FROM campaigns WHERE active = TRUE")
-            total_enrollments = await conn.fetchval("SELECT COUNT(*) FROM enrollments")
+        # One round trip: each table is scanned once, with FILTER doing the sub-counts
+        total_users, total_merchants, pending_merchants, total_campaigns, active_campaigns, total_enrollments = await db.pool.fetchrow("""
+            SELECT u.total, u.merchants, u.pending, c.total, c.active, (SELECT COUNT(*) FROM enrollments)
+            FROM (SELECT COUNT(*) AS total,
+                         COUNT(*) FILTER (WHERE user_type = 'merchant') AS merchants,
+                         COUNT(*) FILTER (WHERE user_type = 'merchant' AND merchant_approved = FALSE) AS pending
+                  FROM users) u,
+                 (SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE active = TRUE) AS active FROM campaigns) c
+        """)
     except Exception as e:
         logger.error(f"Error getting admin stats: {e}")
         total_users = total_merchants = pending_merchants = 0
@@ -718,14 +1001,17 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
 
 async def system_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDS:
+    if update.effective_user.id not in CONFIG.admin_ids:
         return
     try:
-        async with db.pool.acquire() as conn:
-            total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-            new_users_today = await conn.fetchval("SELECT COUNT(*) FROM users WHERE created_at > NOW() - INTERVAL '24 hours'")
-            total_merchants = await conn.fetchval("SELECT COUNT(*) FROM users WHERE user_type = 'merchant'")
-            total_campaigns = await conn.fetchval("SELECT COUNT(*) FROM campaigns")
+        # One round trip: users is scanned once, with FILTER doing the sub-counts
+        total_users, new_users_today, total_merchants, total_campaigns = await db.pool.fetchrow("""
+            SELECT COUNT(*),
+                   COUNT(*) FILTER (WHERE created_at > NOW() - INTERVAL '24 hours'),
+                   COUNT(*) FILTER (WHERE user_type = 'merchant'),
+                   (SELECT COUNT(*) FROM campaigns)
+            FROM users
+        """)
         message = f"📊 *Detailed System Statistics*\n\n*Users*\n• Total: {total_users}\n• New (24h): {new_users_today}\n\n*Merchants*\n• Total: {total_merchants}\n\n*Programs*\n• Total: {total_campaigns}"
         await update.message.reply_text(message + BRAND_FOOTER, parse_mode="Markdown")
     except Exception as e:
@@ -733,141 +1019,254 @@ async def system_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Error retrieving statistics." + BRAND_FOOTER)
 
 async def manage_merchants(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDS:
+    if update.effective_user.id not in CONFIG.admin_ids:
         return
     try:
         async with db.pool.acquire() as conn:
             pending = await conn.fetch("SELECT id, username, first_name FROM users WHERE user_type = 'merchant' AND merchant_approved = FALSE ORDER BY created_at DESC LIMIT 10")
         if not pending:
-            await update.message.reply_text("✅ No pending merchant applications!" + BRAND_FOOTER, parse_mode="Markdown")
+            await reply_or_edit(update, "✅ No pending merchant applications!" + BRAND_FOOTER, parse_mode="Markdown")
             return
         keyboard = []
         for merchant in pending:
             name = merchant['first_name'] or merchant['username'] or f"User {merchant['id']}"
             keyboard.append([InlineKeyboardButton(f"✅ Approve: {name}", callback_data=f"approve_merchant_{merchant['id']}")])
         message = f"🏪 *Pending Merchant Applications*\n\nFound {len(pending)} pending application(s).\nTap to approve:"
-        await update.message.reply_text(message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        await reply_or_edit(update, message + BRAND_FOOTER, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error getting pending merchants: {e}")
-        await update.message.reply_text("❌ Error retrieving merchant applications." + BRAND_FOOTER)
+        await reply_or_edit(update, "❌ Error retrieving merchant applications." + BRAND_FOOTER)
+
+# Reply-keyboard labels handled by handle_text_message
+MENU_ACTIONS = {
+    "💳 My Wallet": wallet,
+    "📍 Find Stores": find_stores,
+    "🆔 Show My ID": myid,
+    "🎁 My Rewards": show_rewards,
+    "⚙️ Settings": settings_menu,
+    "❓ Help": help_command,
+    "📊 Dashboard": dashboard,
+    "⏳ Pending": pending,
+    "📸 Scan Customer": scan_customer_menu,
+    "📋 My Programs": mycampaigns,
+    "➕ New Program": new_program_start,
+}
+ADMIN_MENU_ACTIONS = {
+    "👑 Admin Panel": admin_panel,
+    "📊 System Stats": system_stats,
+    "🏪 Manage Merchants": manage_merchants,
+}
+# Inline navigation buttons handled by button_callback; these views edit the tapped message in place
+NAV_ACTIONS = {
+    "view_wallet": wallet,
+    "find_stores": find_stores,
+    "view_pending_dashboard": pending,
+    "view_programs_dashboard": mycampaigns,
+    "view_my_programs": mycampaigns,
+}
+
+# ==================== CALLBACKS ====================
+
+# Preference each settings toggle flips, and the label for its confirmation
+SETTINGS_TOGGLES = {
+    "settings_notifications": ('notification_enabled', "Notifications"),
+    "settings_marketing": ('marketing_emails', "Marketing emails"),
+    "settings_data": ('data_sharing', "Data sharing"),
+}
+
+async def settings_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    name, label = SETTINGS_TOGGLES[query.data]
+    try:
+        new_value = await db.toggle_user_preference(update.effective_user.id, name)
+        await query.answer(f"{label} {'enabled' if new_value else 'disabled'}!")
+        await settings_menu(update, context)
+    except:
+        await query.answer("Error updating setting")
+
+async def settings_close(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.delete()
+
+async def approve_merchant_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, merchant_id: str):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    if user_id not in CONFIG.admin_ids:
+        await query.answer("Access denied!")
+        return
+    try:
+        await db.approve_merchant(int(merchant_id), user_id)
+        await query.answer("✅ Merchant approved!")
+        await manage_merchants(update, context)
+    except:
+        await query.answer("Error approving merchant")
+
+async def approve_stamps_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: str = None):
+    """Approve one pending stamp request, or all of them when request_id is None"""
+    query = update.callback_query
+    request_ids = None if request_id is None else [int(request_id)]
+    try:
+        # Scoped to this merchant's pending requests in SQL, so nobody else's can be approved
+        approved = await db.approve_stamp_requests_bulk(update.effective_user.id, request_ids)
+    except Exception as e:
+        logger.error(f"Error approving stamps: {e}")
+        await query.message.reply_text("❌ Error approving stamps." + BRAND_FOOTER, parse_mode="Markdown")
+        return
+    if not approved:
+        await query.message.reply_text("✅ Nothing left to approve." + BRAND_FOOTER, parse_mode="Markdown")
+        return
+    await db.queue_notifications(
+        (row['customer_id'], MESSAGES['reward_earned'](campaign=row['name']) if row['just_completed'] else MESSAGES['stamp_approved'](
+            campaign=row['name'], current=row['new_stamps'], total=row['stamps_needed'],
+            progress_bar=generate_progress_bar(row['new_stamps'], row['stamps_needed'], 20), message=""))
+        for row in approved
+    )
+    stamps = sum(row['stamps_added'] for row in approved)
+    if request_id is None:
+        await query.message.edit_text(f"✅ *All caught up!*\n\nApproved {stamps} stamp request(s)." + BRAND_FOOTER, parse_mode="Markdown")
+    else:
+        await query.message.reply_text("✅ Stamp approved!" + BRAND_FOOTER, parse_mode="Markdown")
+
+async def deny_stamp_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: str):
+    """Reject one pending stamp request and let the customer know"""
+    query = update.callback_query
+    try:
+        # Scoped to this merchant's pending requests in SQL, like approvals
+        rejected = await db.reject_stamp_request(int(request_id), update.effective_user.id)
+    except Exception as e:
+        logger.error(f"Error denying stamp: {e}")
+        await query.message.reply_text("❌ Error denying request." + BRAND_FOOTER, parse_mode="Markdown")
+        return
+    if not rejected:
+        await query.message.reply_text("✅ Nothing left to deny." + BRAND_FOOTER, parse_mode="Markdown")
+        return
+    await db.queue_notifications([(rejected['customer_id'], MESSAGES['stamp_rejected'](campaign=rejected['campaign_name']))])
+    await query.message.reply_text("❌ Stamp request denied." + BRAND_FOOTER, parse_mode="Markdown")
+
+async def wallet_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: str):
+    await wallet(update, context, page=int(page))
+
+# Tutorial screens never change, so text and keyboards are built once at import
+TUTORIAL_STEPS = {
+    "start_tutorial": ("🎯 *Quick Tutorial (1/3)*\n\n*Step 1: Join a Program*\n\n• Find stores near you\n• Scan their QR code\n• Start collecting stamps!\n\nSimple as that! 🎉", InlineKeyboardMarkup([[InlineKeyboardButton("Next →", callback_data="tutorial_2")]])),
+    "tutorial_2": ("🎯 *Quick Tutorial (2/3)*\n\n*Step 2: Collect Stamps*\n\n• Show your ID at checkout\n• Merchant scans your QR code\n• You get a stamp instantly!\n\nTrack your progress in 💳 My Wallet", InlineKeyboardMarkup([[InlineKeyboardButton("← Back", callback_data="start_tutorial")], [InlineKeyboardButton("Next →", callback_data="tutorial_3")]])),
+    "tutorial_3": ("🎯 *Quick Tutorial (3/3)*\n\n*Step 3: Get Rewards*\n\n• Complete your card\n• Claim your reward in 🎁 My Rewards\n• Show proof to merchant\n• Enjoy your prize!\n\nReady to start? 🚀", InlineKeyboardMarkup([[InlineKeyboardButton("← Back", callback_data="tutorial_2")], [InlineKeyboardButton("✅ Got it!", callback_data="tutorial_complete")]])),
+    "tutorial_complete": ("✅ *Tutorial Complete!*\n\nYou're all set! Use the menu below to:\n• 📍 Find stores\n• 💳 View your wallet\n• 🆔 Show your ID\n\nHappy stamping! 🎉" + BRAND_FOOTER, None),
+}
+
+async def tutorial_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text, markup = TUTORIAL_STEPS[update.callback_query.data]
+    await update.callback_query.message.edit_text(text, reply_markup=markup, parse_mode="Markdown")
+
+# Callback data matched whole: handler(update, context)
+CALLBACK_ACTIONS = {
+    **dict.fromkeys(SETTINGS_TOGGLES, settings_toggle),
+    "settings_close": settings_close,
+    "approve_all": approve_stamps_callback,
+    **dict.fromkeys(TUTORIAL_STEPS, tutorial_step),
+    **NAV_ACTIONS,
+}
+# Callback data of the form <prefix>_<id>: handler(update, context, id)
+CALLBACK_PREFIX_ACTIONS = {
+    "approve_merchant": approve_merchant_callback,
+    "approve_stamp": approve_stamps_callback,
+    "deny_stamp": deny_stamp_callback,
+    "wallet_page": wallet_page,
+}
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     data = query.data
     user_id = update.effective_user.id
+    allowed, _ = callback_limiter.check_rate_limit(user_id)
+    if not allowed:
+        try:
+            await query.answer("⚠️ Please slow down! Wait a moment.", show_alert=True)
+        except:
+            pass
+        return
     try:
         await query.answer()
     except:
         pass
     
-    if data.startswith("settings_"):
-        if data == "settings_notifications":
-            try:
-                async with db.pool.acquire() as conn:
-                    current = await conn.fetchval("SELECT notification_enabled FROM user_preferences WHERE user_id = $1", user_id)
-                    new_value = not current
-                    await conn.execute("UPDATE user_preferences SET notification_enabled = $1 WHERE user_id = $2", new_value, user_id)
-                await query.answer(f"Notifications {'enabled' if new_value else 'disabled'}!")
-                await settings_menu(update, context)
-            except:
-                await query.answer("Error updating setting")
-        elif data == "settings_marketing":
-            try:
-                async with db.pool.acquire() as conn:
-                    current = await conn.fetchval("SELECT marketing_emails FROM user_preferences WHERE user_id = $1", user_id)
-                    new_value = not current
-                    await conn.execute("UPDATE user_preferences SET marketing_emails = $1 WHERE user_id = $2", new_value, user_id)
-                await query.answer(f"Marketing emails {'enabled' if new_value else 'disabled'}!")
-                await settings_menu(update, context)
-            except:
-                await query.answer("Error updating setting")
-        elif data == "settings_data":
-            try:
-                async with db.pool.acquire() as conn:
-                    current = await conn.fetchval("SELECT data_sharing FROM user_preferences WHERE user_id = $1", user_id)
-                    new_value = not current
-                    await conn.execute("UPDATE user_preferences SET data_sharing = $1 WHERE user_id = $2", new_value, user_id)
-                await query.answer(f"Data sharing {'enabled' if new_value else 'disabled'}!")
-                await settings_menu(update, context)
-            except:
-                await query.answer("Error updating setting")
-        elif data == "settings_close":
-            await query.message.delete()
-    elif data.startswith("approve_merchant_"):
-        if user_id not in ADMIN_IDS:
-            await query.answer("Access denied!")
-            return
-        merchant_id = int(data.split("_")[2])
-        try:
-            async with db.pool.acquire() as conn:
-                await conn.execute("UPDATE users SET merchant_approved = TRUE WHERE id = $1", merchant_id)
-            await query.answer("✅ Merchant approved!")
-            await manage_merchants(update, context)
-        except:
-            await query.answer("Error approving merchant")
-    elif data == "start_tutorial":
-        keyboard = [[InlineKeyboardButton("Next →", callback_data="tutorial_2")]]
-        await query.message.edit_text("🎯 *Quick Tutorial (1/3)*\n\n*Step 1: Join a Program*\n\n• Find stores near you\n• Scan their QR code\n• Start collecting stamps!\n\nSimple as that! 🎉", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-    elif data == "tutorial_2":
-        keyboard = [[InlineKeyboardButton("← Back", callback_data="start_tutorial")], [InlineKeyboardButton("Next →", callback_data="tutorial_3")]]
-        await query.message.edit_text("🎯 *Quick Tutorial (2/3)*\n\n*Step 2: Collect Stamps*\n\n• Show your ID at checkout\n• Merchant scans your QR code\n• You get a stamp instantly!\n\nTrack your progress in 💳 My Wallet", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-    elif data == "tutorial_3":
-        keyboard = [[InlineKeyboardButton("← Back", callback_data="tutorial_2")], [InlineKeyboardButton("✅ Got it!", callback_data="tutorial_complete")]]
-        await query.message.edit_text("🎯 *Quick Tutorial (3/3)*\n\n*Step 3: Get Rewards*\n\n• Complete your card\n• Claim your reward in 🎁 My Rewards\n• Show proof to merchant\n• Enjoy your prize!\n\nReady to start? 🚀", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
-    elif data == "tutorial_complete":
-        await query.message.edit_text("✅ *Tutorial Complete!*\n\nYou're all set! Use the menu below to:\n• 📍 Find stores\n• 💳 View your wallet\n• 🆔 Show your ID\n\nHappy stamping! 🎉" + BRAND_FOOTER, parse_mode="Markdown")
+    # Two dict lookups instead of walking a chain of comparisons
+    handler = CALLBACK_ACTIONS.get(data)
+    if handler:
+        await handler(update, context)
+        return
+    prefix, _, arg = data.rpartition("_")
+    handler = CALLBACK_PREFIX_ACTIONS.get(prefix)
+    if handler:
+        await handler(update, context, arg)
     else:
         await query.answer("Action processed!")
 
+NOTIFICATION_BATCH = 50
+
 async def send_notifications(app):
+    """Deliver queued notifications as soon as the notifications trigger reports new ones"""
     while True:
         try:
-            await asyncio.sleep(5)
+            # The timeout doubles as a sweep for anything a missed NOTIFY or failed send left behind
+            await db.wait_for_notifications(timeout=60)
+            while True:
+                batch = await db.get_pending_notifications(NOTIFICATION_BATCH)
+                sent_ids = []
+                # Failures are counted by type and logged once per batch; a flood-control wave
+                # would otherwise write a line for every message
+                dropped = Counter()
+                retrying = Counter()
+                
+                async def send_one(notif):
+                    try:
+                        async with send_bucket:
+                            await app.bot.send_message(notif['user_id'], notif['message'], parse_mode="Markdown")
+                    except (Forbidden, BadRequest) as e:
+                        # Blocked bot or bad chat: retrying can't help, so drop it
+                        dropped[type(e).__name__] += 1
+                    except Exception as e:
+                        retrying[type(e).__name__] += 1
+                        return
+                    sent_ids.append(notif['id'])
+                
+                try:
+                    # Sends overlap their round trips; the bucket keeps the rate under Telegram's cap
+                    await asyncio.gather(*(send_one(notif) for notif in batch))
+                finally:
+                    # One UPDATE for the whole batch, even if it was cut short, so nothing is sent twice
+                    if sent_ids:
+                        await db.mark_notifications_sent(sent_ids)
+                if dropped or retrying:
+                    logger.warning(f"Notifications: {len(sent_ids)} sent, dropped {dict(dropped)}, will retry {dict(retrying)}")
+                # A short batch means the queue is drained; a batch that made no progress waits for the sweep
+                if len(batch) < NOTIFICATION_BATCH or not sent_ids:
+                    break
         except Exception as e:
             logger.error(f"Error in notifications: {e}")
             await asyncio.sleep(5)
 
 async def send_daily_summaries():
-    pass
-
-async def main():
-    print("🚀 Starting StampMe Bot...")
-    print("🔄 Clearing any existing bot instances...")
-    for attempt in range(5):
-        try:
-            temp_app = ApplicationBuilder().token(TOKEN).build()
-            await temp_app.initialize()
-            for i in range(3):
-                result = await temp_app.bot.delete_webhook(drop_pending_updates=True)
-                print(f"    ✓ Webhook clear attempt {i+1}: {result}")
-                await asyncio.sleep(2)
-            await temp_app.shutdown()
-            print(f"  ✓ Attempt {attempt + 1}: All clear")
-            await asyncio.sleep(5)
-            break
-        except Exception as e:
-            print(f"  ⚠️ Attempt {attempt + 1} failed: {e}")
-            if attempt < 4:
-                wait_time = (attempt + 1) * 3
-                print(f"  ⏳ Waiting {wait_time} seconds before retry...")
-                await asyncio.sleep(wait_time)
-            else:
-                print("\n❌ CRITICAL: Could not clear old instances after 5 attempts")
-                return
-    
+    # One aggregate query for every merchant, then one batched insert; the notification
+    # loop picks them up and paces the sends
     try:
-        await db.connect()
-        print("✅ Database connected")
-        print("\n🔄 Running migrations...")
-        await run_migrations(db.pool)
-        print("✅ Migrations complete!\n")
+        rows = await db.get_daily_summaries()
+        today = date.today().strftime('%d %b %Y')
+        tip = tip_of_the_day()
+        await db.queue_notifications(
+            (row['merchant_id'], MESSAGES['daily_merchant_summary'](
+                date=today, visits=row['visits'], new_customers=row['new_customers'],
+                rewards=row['rewards_claimed'], pending=row['pending'], tip=tip))
+            for row in rows
+        )
+        logger.info(f"Queued daily summaries for {len(rows)} merchants")
     except Exception as e:
-        print(f"❌ Database error: {e}")
-        return
-    
-    await start_web_server()
-    print("🤖 Building bot...")
-    app = ApplicationBuilder().token(TOKEN).build()
+        logger.error(f"Error sending daily summaries: {e}")
+
+def build_app(token: str):
+    """The bot application with every handler registered, ready to initialize"""
+    # Updates are handled concurrently so one user's DB waits don't hold up everyone else's;
+    # past the pool's max_size, handlers simply queue on pool.acquire()
+    app = ApplicationBuilder().token(token).concurrent_updates(CONFIG.concurrent_updates).build()
     
     program_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("newprogram", new_program_start), MessageHandler(filters.Regex("^➕ New Program$"), new_program_start)],
@@ -887,6 +1286,8 @@ async def main():
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("wallet", wallet))
     app.add_handler(CommandHandler("myid", myid))
+    app.add_handler(CommandHandler("getqr", getqr))
+    app.add_handler(CommandHandler("merchant", request_merchant))
     app.add_handler(CommandHandler("pending", pending))
     app.add_handler(CommandHandler("dashboard", dashboard))
     app.add_handler(CommandHandler("mycampaigns", mycampaigns))
@@ -894,55 +1295,119 @@ async def main():
     app.add_handler(CommandHandler("admin", admin_panel))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     app.add_handler(CallbackQueryHandler(button_callback))
+    return app
+
+async def main():
+    logger.info("🚀 Starting StampMe Bot...")
+    logger.info("🔄 Clearing any existing bot instances...")
+    for attempt in range(5):
+        try:
+            # A bare Bot is enough for delete_webhook; no need to build a whole Application
+            async with Bot(CONFIG.token) as bot:
+                for i in range(3):
+                    result = await bot.delete_webhook(drop_pending_updates=True)
+                    logger.info(f"✓ Webhook clear attempt {i+1}: {result}")
+                    await asyncio.sleep(2)
+            logger.info(f"✓ Attempt {attempt + 1}: All clear")
+            await asyncio.sleep(5)
+            break
+        except Exception as e:
+            logger.warning(f"⚠️ Attempt {attempt + 1} failed: {e}")
+            if attempt < 4:
+                wait_time = (attempt + 1) * 3
+                logger.info(f"⏳ Waiting {wait_time} seconds before retry...")
+                await asyncio.sleep(wait_time)
+            else:
+                logger.critical("❌ Could not clear old instances after 5 attempts")
+                return
     
-    await app.initialize()
-    await app.start()
-    print("📡 Starting polling...")
-    await app.updater.start_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
-    print("✅ Bot is running!")
-    print(f"📱 Bot: @{BOT_USERNAME}")
-    print(f"👑 Admin IDs: {ADMIN_IDS}")
-    
-    asyncio.create_task(send_notifications(app))
-    scheduler.add_job(send_daily_summaries, 'cron', hour=18, minute=0)
-    scheduler.start()
-    
-    print("\n🧪 Creating sample test data...")
     try:
-        async with db.pool.acquire() as conn:
-            test_merchant = await conn.fetchval("SELECT id FROM users WHERE id = 999999991 LIMIT 1")
-            if not test_merchant:
-                await conn.execute("INSERT INTO users (id, username, first_name, user_type, merchant_approved) VALUES (999999991, 'testcafe', 'Test Cafe', 'merchant', TRUE) ON CONFLICT (id) DO NOTHING")
-                await conn.execute("INSERT INTO campaigns (merchant_id, name, stamps_needed, reward_description, category, description, active) VALUES (999999991, 'Coffee Lover Card', 8, 'Free Coffee', 'Food & Beverage', 'Get 8 stamps, get 1 free coffee!', TRUE) ON CONFLICT DO NOTHING")
-                print("  ✓ Test merchant created (ID: 999999991)")
-                print("  ✓ Test campaign created")
-                print("  ℹ️  Use /start join_1 to test as customer")
-            else:
-                print("  ℹ️  Test data already exists")
+        await db.connect()
+        await run_migrations(db.pool)
+        await db.ensure_transaction_partitions()
     except Exception as e:
-        logger.error(f"Error creating test data: {e}")
-        print("  ⚠️  Could not create test data")
-    
-    print("\n" + "="*50)
-    print("🎉 STAMPME BOT READY!")
-    print("="*50)
-    print("\n📋 TESTING GUIDE:")
-    print("1. Start as admin: /start")
-    print("2. Test merchant: ID 999999991")
-    print("3. Join test program: /start join_1")
-    print("4. View wallet: 💳 My Wallet")
-    print("5. Show ID: 🆔 Show My ID")
-    print("\n" + "="*50 + "\n")
+        logger.exception(f"❌ Database error: {e}")
+        await db.close()
+        return
     
-    await asyncio.Event().wait()
+    app = None
+    runner = None
+    try:
+        logger.info("🤖 Building bot...")
+        app = build_app(CONFIG.token)
+        runner = await start_web_server(app)
+        
+        await app.initialize()
+        await app.start()
+        # Only messages and button taps have handlers, so nothing else is fetched
+        allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+        if CONFIG.webhook_url:
+            # Telegram POSTs each update to the web server above: no polling round trips at all
+            logger.info("📡 Setting webhook...")
+            await app.bot.set_webhook(url=CONFIG.webhook_url + WEBHOOK_PATH, allowed_updates=allowed_updates, drop_pending_updates=True, secret_token=CONFIG.webhook_secret)
+        else:
+            logger.info("📡 Starting polling...")
+            # The long poll holds each getUpdates open up to 50 s (PTB adds it to the read timeout) rather than 10
+            await app.updater.start_polling(drop_pending_updates=True, allowed_updates=allowed_updates, timeout=50)
+        logger.info(f"✅ Bot is running! 📱 Bot: @{CONFIG.bot_username} 👑 Admin IDs: {sorted(CONFIG.admin_ids)}")
+        
+        asyncio.create_task(send_notifications(app))
+        scheduler.add_job(send_daily_summaries, 'cron', hour=18, minute=0, id='daily_summaries')
+        scheduler.add_job(db.ensure_transaction_partitions, 'cron', day=1, hour=0, minute=5, id='transaction_partitions')
+        scheduler.start()
+        
+        logger.info("🧪 Creating sample test data...")
+        try:
+            async with db.pool.acquire() as conn:
+                test_merchant = await conn.fetchval("SELECT id FROM users WHERE id = 999999991 LIMIT 1")
+                if not test_merchant:
+                    await conn.execute("INSERT INTO users (id, username, first_name, user_type, merchant_approved) VALUES (999999991, 'testcafe', 'Test Cafe', 'merchant', TRUE) ON CONFLICT (id) DO NOTHING")
+                    await conn.execute("INSERT INTO campaigns (merchant_id, name, stamps_needed, reward_description, category, description, active) VALUES (999999991, 'Coffee Lover Card', 8, 'Free Coffee', 'Food & Beverage', 'Get 8 stamps, get 1 free coffee!', TRUE) ON CONFLICT DO NOTHING")
+                    logger.info("✓ Test merchant (ID: 999999991) and campaign created; use /start join_1 to test as customer")
+                else:
+                    logger.info("ℹ️ Test data already exists")
+        except Exception as e:
+            logger.error(f"⚠️ Could not create test data: {e}")
+        
+        logger.info(
+            "🎉 STAMPME BOT READY!\n"
+            "📋 TESTING GUIDE:\n"
+            "1. Start as admin: /start\n"
+            "2. Test merchant: ID 999999991\n"
+            "3. Join test program: /start join_1\n"
+            "4. View wallet: 💳 My Wallet\n"
+            "5. Show ID: 🆔 Show My ID"
+        )
+        
+        # On SIGTERM (container stop) only wake main(); the pool has to outlive the handlers it serves
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        await stop.wait()
+        logger.info("👋 Shutting down...")
+    finally:
+        # Runs on SIGTERM, Ctrl+C and crashes alike: stop taking updates, then flush the
+        # buffered daily_stats and close the pool
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+        if runner is not None:
+            await runner.cleanup()
+        if app is not None:
+            if app.updater.running:
+                await app.updater.stop()
+            if app.running:
+                await app.stop()
+            await app.shutdown()
+        await db.close(timeout=10)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        # libuv's C event loop when it's installed, the stock loop otherwise
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
-        print("\n👋 Bot stopped")
+        logger.info("👋 Bot stopped")
     except Exception as e:
-        print(f"\n❌ Fatal error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Fatal error: {e}")
+    finally:
+        log_listener.stop()
 
@@ -0,0 +1,134 @@
+"""Behaviour tests for the multi-statement SQL in database_complete.
+
+They run against a real PostgreSQL named by TEST_DATABASE_URL. Every test drops and recreates
+the schema from migrate_database.py, so point it at a throwaway database, never a live one.
+"""
+import asyncio
+import os
+
+import pytest
+
+asyncpg = pytest.importorskip("asyncpg")
+
+from database_complete import StampMeDatabase
+from migrate_database import SCHEMA, TABLES_TO_DROP
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+MERCHANT, OTHER_MERCHANT, CUSTOMER, OTHER_CUSTOMER = 1, 2, 10, 11
+
+# Two merchants with a 3-stamp campaign each (ids 1 and 2), and two customers
+SEED = f'''
+    INSERT INTO users (id, first_name, user_type, merchant_approved) VALUES
+        ({MERCHANT}, 'Cafe', 'merchant', TRUE),
+        ({OTHER_MERCHANT}, 'Bakery', 'merchant', TRUE),
+        ({CUSTOMER}, 'Ann', 'customer', FALSE),
+        ({OTHER_CUSTOMER}, 'Bob', 'customer', FALSE);
+    INSERT INTO campaigns (merchant_id, name, stamps_needed) VALUES
+        ({MERCHANT}, 'Coffee Card', 3),
+        ({OTHER_MERCHANT}, 'Bread Card', 3);
+'''
+
+
+def run(test):
+    """Reset the schema, then run test(db) against a connected StampMeDatabase"""
+    async def main():
+        conn = await asyncpg.connect(TEST_DATABASE_URL)
+        try:
+            await conn.execute(f"DROP TABLE IF EXISTS {', '.join(TABLES_TO_DROP)} CASCADE;" + SCHEMA + SEED)
+        finally:
+            await conn.close()
+        db = StampMeDatabase(TEST_DATABASE_URL, min_size=1, max_size=8)
+        await db.connect()
+        try:
+            await test(db)
+        finally:
+            await db.close()
+    asyncio.run(main())
+
+
+async def pending_request(db, campaign_id, customer_id, merchant_id, stamps=0):
+    """Enroll the customer with stamps already on the card and open one pending request"""
+    enrollment = await db.enroll_customer(campaign_id, customer_id)
+    if stamps:
+        await db.pool.execute('UPDATE enrollments SET stamps = $2 WHERE id = $1', enrollment['id'], stamps)
+    request_id = await db.create_stamp_request(campaign_id, customer_id, merchant_id, enrollment['id'])
+    return enrollment['id'], request_id
+
+
+def test_enroll_customer_joins_once():
+    async def test(db):
+        first = await db.enroll_customer(1, CUSTOMER)
+        again = await db.enroll_customer(1, CUSTOMER)
+        assert first['joined'] and not again['joined']
+        assert again['id'] == first['id'] and again['stamps'] == 0
+        assert await db.pool.fetchval('SELECT total_joins FROM campaigns WHERE id = 1') == 1
+    run(test)
+
+
+def test_enroll_customer_concurrent_first_joins_all_get_the_row():
+    async def test(db):
+        rows = await asyncio.gather(*(db.enroll_customer(1, CUSTOMER) for _ in range(8)))
+        assert all(row is not None for row in rows)
+        assert len({row['id'] for row in rows}) == 1
+        assert sum(row['joined'] for row in rows) == 1
+        assert await db.pool.fetchval('SELECT total_joins FROM campaigns WHERE id = 1') == 1
+    run(test)
+
+
+def test_approve_bulk_stamps_and_completes_once_per_card():
+    async def test(db):
+        enrollment_id, _ = await pending_request(db, 1, CUSTOMER, MERCHANT, stamps=2)
+        await db.create_stamp_request(1, CUSTOMER, MERCHANT, enrollment_id)
+
+        rows = await db.approve_stamp_requests_bulk(MERCHANT)
+
+        # Both requests land on one card in a single update
+        assert len(rows) == 1
+        row = rows[0]
+        assert (row['customer_id'], row['campaign_id'], row['name']) == (CUSTOMER, 1, 'Coffee Card')
+        assert (row['stamps_added'], row['new_stamps'], row['just_completed']) == (2, 4, True)
+        enrollment = await db.pool.fetchrow('SELECT * FROM enrollments WHERE id = $1', enrollment_id)
+        assert enrollment['stamps'] == 4 and enrollment['completed'] and enrollment['completed_at'] is not None
+        assert await db.pool.fetchval('SELECT total_completions FROM campaigns WHERE id = 1') == 1
+        user = await db.pool.fetchrow('SELECT * FROM users WHERE id = $1', CUSTOMER)
+        assert (user['total_stamps_earned'], user['total_rewards_claimed']) == (2, 1)
+        assert await db.pool.fetchval('SELECT COUNT(*) FROM transactions WHERE enrollment_id = $1', enrollment_id) == 2
+        assert await db.pool.fetchval("SELECT COUNT(*) FROM stamp_requests WHERE status = 'pending'") == 0
+
+        # Nothing left: a second approval is a no-op
+        assert await db.approve_stamp_requests_bulk(MERCHANT) == []
+    run(test)
+
+
+def test_approve_bulk_past_completion_keeps_completed_at_and_counters():
+    async def test(db):
+        enrollment_id, _ = await pending_request(db, 1, CUSTOMER, MERCHANT, stamps=2)
+        await db.approve_stamp_requests_bulk(MERCHANT)
+        completed_at = await db.pool.fetchval('SELECT completed_at FROM enrollments WHERE id = $1', enrollment_id)
+
+        await db.create_stamp_request(1, CUSTOMER, MERCHANT, enrollment_id)
+        rows = await db.approve_stamp_requests_bulk(MERCHANT)
+
+        assert [row['just_completed'] for row in rows] == [False]
+        assert await db.pool.fetchval('SELECT completed_at FROM enrollments WHERE id = $1', enrollment_id) == completed_at
+        assert await db.pool.fetchval('SELECT total_completions FROM campaigns WHERE id = 1') == 1
+        assert await db.pool.fetchval('SELECT total_rewards_claimed FROM users WHERE id = $1', CUSTOMER) == 1
+    run(test)
+
+
+def test_approve_bulk_only_touches_the_merchants_named_requests():
+    async def test(db):
+        _, mine = await pending_request(db, 1, CUSTOMER, MERCHANT)
+        _, also_mine = await pending_request(db, 1, OTHER_CUSTOMER, MERCHANT)
+        _, theirs = await pending_request(db, 2, CUSTOMER, OTHER_MERCHANT)
+
+        # Another merchant's request id is ignored even when named explicitly
+        rows = await db.approve_stamp_requests_bulk(MERCHANT, [mine, theirs])
+
+        assert [row['customer_id'] for row in rows] == [CUSTOMER]
+        status = dict(await db.pool.fetch('SELECT id, status FROM stamp_requests'))
+        assert status == {mine: 'approved', also_mine: 'pending', theirs: 'pending'}
+    run(test)